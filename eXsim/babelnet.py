@@ -1,6 +1,15 @@
 from eXsim.models import *
-from neo4j import GraphDatabase
+from flask import g, has_request_context
+from eXsim.cache import LRUCache, SortedIds
+from eXsim.graph_snapshot import GraphSnapshot, load_snapshot
+from eXsim.lca import strongly_connected_components
+from eXsim.statements import relation_template, run_statement, statement_stats
+from neo4j import GraphDatabase, READ_ACCESS, unit_of_work
+from neo4j.exceptions import Neo4jError
+import os
 import re
+import threading
+
 
 def init_relation_ranking() -> dict[str, int]:
     rel_ranking = {}
@@ -22,13 +31,65 @@ def init_relation_ranking() -> dict[str, int]:
     return rel_ranking
 
 
-def get_summary_config_query(tx, synset_id: str) -> list[SummaryConfigEntry]:
-    result = tx.run("MATCH (:Synset {id: $id})-[r]->(:Synset) RETURN DISTINCT type(r) AS name, r.kind AS kind",
-                    id=synset_id)
+SUMMARY_CONFIG_QUERY = "MATCH (:Synset {id: $id})-[r]->(:Synset) RETURN DISTINCT type(r) AS name, r.kind AS kind"
+
+BFS_TREE_QUERY = ("UNWIND $terms AS term MATCH (root:Synset {id: term}) " +
+                  "CALL apoc.path.expandConfig(root, {relationshipFilter: $filter, labelFilter: '+Synset', minLevel: 1, " +
+                  "maxLevel: $depth, bfs: true, uniqueness: 'NODE_GLOBAL'}) YIELD path " +
+                  "RETURN term AS root, last(nodes(path)).id AS id, nodes(path)[-2].id AS parent, length(path) AS depth")
+
+# subgraphAll accepts the whole list of seeds as start nodes, so no auxiliary node has to be created
+SUBGRAPHS_QUERY = ("MATCH (e:Synset) WHERE e.id IN $terms WITH collect(e) AS seeds " +
+                   "CALL apoc.path.subgraphAll(seeds, {relationshipFilter: $filter}) YIELD relationships " +
+                   "UNWIND relationships AS relation WITH relation WHERE type(relation) = $rel " +
+                   "RETURN DISTINCT startNode(relation).id AS x, endNode(relation).id AS y")
+
+AVAILABLE_RELATIONS_QUERY = "CALL db.relationshipTypes()"
+
+SYNSET_COUNT_QUERY = "MATCH (n:Synset) RETURN count(n) as count"
+
+SYNSET_BY_ID_QUERY = ("MATCH (node:Synset {id: $id}) RETURN node.id as id, node.main_sense as main_sense, " +
+                      "node.synonyms as synonyms, node.description as description, node.image_url as image_url")
+
+SYNSETS_BY_ID_BATCHED_QUERY = ("UNWIND $terms AS term MATCH (node:Synset {id: term}) RETURN node.id as id, " +
+                               "node.main_sense as main_sense, node.synonyms as synonyms, " +
+                               "node.description as description, node.image_url as image_url")
+
+IN_RANK_BATCHED_QUERY = ("UNWIND $terms AS term MATCH (node:Synset {id: term}) RETURN node.id as id, " +
+                         "node.hyperInRank as hyperInRank, node.holonymInRank as holonymInRank")
+
+
+# Degrees are read from the node relationship counters, without expanding the relationships
+IN_DEGREE_BATCHED_QUERY = ("UNWIND $pairs AS pair MATCH (node:Synset {id: pair[0]}) " +
+                           "RETURN node.id as id, pair[1] as relation, apoc.node.degree.in(node, pair[1]) as degree")
+
+SYNSETS_BY_LEMMA_QUERY = ('CALL db.index.fulltext.queryNodes("mainSensesAndSynonyms", $search) YIELD node, score ' +
+                          "WITH node, score ORDER BY node.num_rel*score DESC, node.id " +
+                          "RETURN node.id as id, node.main_sense as main_sense, node.synonyms as synonyms, " +
+                          "node.description as description, node.image_url as image_url SKIP $skip LIMIT $limit")
+
+LEMMA_PAGE_SIZE = 10
+
+reached_synsets_statement = relation_template(
+    "UNWIND $terms AS term MATCH (:Synset {id: term})-[:{rel}]->(x:Synset) RETURN term as source, x.id as id")
+
+reached_synsets_variable_statement = relation_template(
+    "UNWIND $terms AS term MATCH (:Synset {id: term})-[:{rel}*]->(x:Synset) " +
+    "WITH DISTINCT term as source, x.id as id RETURN source, id")
+
+
+def subgraphs_params(terms: list, rtype: PredicateType) -> dict or None:
+    if rtype not in [PredicateType.HYPERNYM, PredicateType.HOLONYM]:
+        return None
 
+    rel_name = "IS_A" if rtype == PredicateType.HYPERNYM else "PART_OF"
+    return {"terms": terms, "filter": rel_name + ">", "rel": rel_name}
+
+
+def to_summary_config_entries(records) -> list[SummaryConfigEntry]:
     entries = []
 
-    for record in result:
+    for record in records:
         record_kind = PredicateType(record["kind"])
         if record_kind not in [PredicateType.MERONYM, PredicateType.HYPONYM]:
             entry = SummaryConfigEntry(record_kind, record["name"], DatasetManager().default_depths[record_kind])
@@ -37,244 +98,398 @@ def get_summary_config_query(tx, synset_id: str) -> list[SummaryConfigEntry]:
     return entries
 
 
-def remove_lucene_special_characters(lemma):
-    lucene_special_characters = r'+-!(){}[]<>/^"~*?:\\'
-    escaped_query = re.sub(r'([{}])'.format(re.escape(lucene_special_characters)), '', lemma)
-    return escaped_query
+def to_pairs(records, first: str, second: str) -> list[tuple[str, str]]:
+    pairs = []
 
+    for record in records:
+        pairs.append((record[first], record[second]))
 
-def get_synsets_by_lemma_query(tx, lemma: str, page: int = 0) -> list[Term]:
-    lemma = remove_lucene_special_characters(lemma)
-    tokens = lemma.split(" ")
+    return pairs
 
-    if len(tokens) == 0:
-        return []
 
-    params = {}
-    count_lemma = 0
-    main_sense_str = ""
-    synonyms_str = ""
-    params_str = ""
+def pairs_to_map(pairs: list[tuple[str, str]]) -> dict[str, list[str]]:
+    synsets = {}
 
-    for token in tokens:
-        if token == "":
-            continue
+    for pair in pairs:
+        if pair[0] not in synsets:
+            synsets[pair[0]] = []
+        synsets[pair[0]].append(pair[1])
 
-        params[f"l{count_lemma}"] = token
-        params_str += f"$l{count_lemma},"
-        count_lemma += 1
+    return synsets
 
-        main_sense_str += "main_sense:%s* AND "
-        synonyms_str += "synonyms:%s AND "
 
-    main_sense_str = f"({main_sense_str[:-5]})^3"
-    synonyms_str = f"({synonyms_str[:-5]})"
-    params_str = f"[{(params_str + params_str)[:-1]}]"
+def to_reached_map(records, terms: list) -> dict[str, list[str]]:
+    synsets = {}
+    for term in terms:
+        synsets[term] = []
 
-    if page < 0:
-        page = 0
+    for record in records:
+        synsets[record["source"]].append(record["id"])
+
+    return synsets
+
+
+def to_bfs_tree(records) -> list[tuple[str, str, str, int]]:
+    tree = []
+
+    for record in records:
+        tree.append((record["root"], record["id"], record["parent"], record["depth"]))
+
+    return tree
 
-    skip = page * 10
 
-    result = tx.run(f"""CALL db.index.fulltext.queryNodes("mainSensesAndSynonyms", 
-    apoc.text.format("{main_sense_str} OR {synonyms_str}", {params_str})) YIELD node,
-                     score WITH node, score ORDER BY node.num_rel*score DESC, node.id 
-                    RETURN node.id as id, node.main_sense as main_sense, node.synonyms as synonyms, 
-                    node.description as description, node.image_url as image_url SKIP {skip} LIMIT 10"""
-                    , parameters=params)
+def to_available_relations(records) -> dict[str, bool]:
+    relations = {}
+
+    for record in records:
+        relations[record["relationshipType"]] = True
+
+    return relations
 
+
+def to_terms(records) -> list[Term]:
     entities = []
 
-    for record in result:
-        entities.append(Term(record["id"], babelnet_entity=BabelNetEntity(record["main_sense"], record["description"],
-                                                                         record["synonyms"], record["image_url"])))
+    for record in records:
+        entities.append(Term(record["id"]))
 
     return entities
 
 
-def get_reached_synsets_query(tx, _id: str, rel: str):
-    if DatasetManager().available_relations.get(rel, False):
-        result = tx.run("MATCH (:Synset {id: $id})-[:`" + rel + "`]->(x:Synset) RETURN x.id as id", id=_id)
+def to_ids(records) -> list[str]:
+    ids = []
 
-        synsets = []
+    for record in records:
+        ids.append(record["id"])
 
-        for record in result:
-            synsets.append(record["id"])
+    return ids
 
-        return synsets
 
-    return []
+def to_synset_records(records) -> list[tuple]:
+    entities = []
 
+    for record in records:
+        entities.append(synset_record(record))
 
-def get_reached_synsets_query_batched(tx, terms: list, rel: str):
-    if DatasetManager().available_relations.get(rel, False):
-        result = tx.run(
-            "UNWIND $terms AS term MATCH (:Synset {id: term})-[:`" + rel +
-            "`]->(x:Synset) RETURN term as source, x.id as id",
-            terms=terms)
+    return entities
 
-        synsets = []
 
-        for record in result:
-            synsets.append((record["source"], record["id"]))
+def to_in_ranks(records) -> list[tuple[str, int, int]]:
+    entities = []
 
-        return synsets
+    for record in records:
+        entities.append((record["id"], record["hyperInRank"], record["holonymInRank"]))
 
-    return []
+    return entities
 
 
-def get_reached_synsets_variable_query_batched(tx, terms: list, rel: str):
-    if DatasetManager().available_relations.get(rel, False):
-        result = tx.run(
-            "UNWIND $terms AS term MATCH (:Synset {id: term})-[:`" + rel +
-            "`*]->(x:Synset) WITH DISTINCT term as source, x.id as id RETURN source, id",
-            terms=terms)
+def to_in_degrees(records) -> dict[tuple[str, str], int]:
+    degrees = {}
 
-        synsets = {}
-        for term in terms:
-            synsets[term] = []
+    for record in records:
+        degrees[(record["id"], record["relation"])] = record["degree"]
 
-        for record in result:
-            synsets[record["source"]].append(record["id"])
+    return degrees
 
-        return synsets
 
-    return {}
+def to_plan_operators(plan: dict, depth: int = 0) -> list[dict]:
+    # Depth first flattening of a PROFILE/EXPLAIN plan, db hits and rows are only available with PROFILE
+    arguments = plan.get("args", plan.get("arguments", {}))
+    operators = [{"operator": plan.get("operatorType"), "depth": depth, "details": arguments.get("Details"),
+                  "estimated_rows": arguments.get("EstimatedRows"), "rows": plan.get("rows"),
+                  "db_hits": plan.get("dbHits")}]
 
+    for child in plan.get("children", []):
+        operators.extend(to_plan_operators(child, depth + 1))
 
-def get_reached_synsets_hypernym_query(tx, _id: str):
-    result = tx.run("MATCH (:Synset {id: $id})-[:IS_A]->(x:Synset) RETURN x.id as id", id=_id)
+    return operators
 
-    synsets = []
 
-    for record in result:
-        synsets.append(record["id"])
+def get_summary_config_query(tx, synset_id: str) -> list[SummaryConfigEntry]:
+    return to_summary_config_entries(run_statement(tx, SUMMARY_CONFIG_QUERY, {"id": synset_id}))
 
-    return synsets
 
+def remove_lucene_special_characters(lemma):
+    lucene_special_characters = r'+-!(){}[]<>/^"~*?:\\'
+    escaped_query = re.sub(r'([{}])'.format(re.escape(lucene_special_characters)), '', lemma)
+    return escaped_query
 
-def get_reached_synsets_hypernym_query_batched(tx, terms: list):
-    result = tx.run(
-        "UNWIND $terms AS term MATCH (:Synset {id: term})-[:IS_A]->(x:Synset) RETURN term as source, x.id as id",
-        terms=terms)
 
-    synsets = []
+def synset_record(record) -> tuple:
+    synonyms = record["synonyms"]
+    return (record["id"], record["main_sense"], record["description"],
+            tuple(synonyms) if synonyms is not None else (), record["image_url"])
 
-    for record in result:
-        synsets.append((record["source"], record["id"]))
 
-    return synsets
+def synset_record_to_term(record: tuple) -> Term:
+    return Term(record[0], babelnet_entity=BabelNetEntity(record[1], record[2], list(record[3]), record[4]))
 
 
-def get_subgraphs_query(tx, terms: list, rtype:PredicateType):
-    if rtype not in [PredicateType.HYPERNYM, PredicateType.HOLONYM]:
+def synsets_by_lemma_statement(lemma: str, page: int = 0) -> tuple[str, dict] or None:
+    lemma = remove_lucene_special_characters(lemma)
+    tokens = [token for token in lemma.split(" ") if token != ""]
+
+    if len(tokens) == 0:
+        return None
+
+    # The Lucene query is assembled here rather than with apoc.text.format, so that every search shares one statement
+    main_sense_str = " AND ".join(map(lambda token: f"main_sense:{token}*", tokens))
+    synonyms_str = " AND ".join(map(lambda token: f"synonyms:{token}", tokens))
+
+    if page < 0:
+        page = 0
+
+    return SYNSETS_BY_LEMMA_QUERY, {"search": f"({main_sense_str})^3 OR ({synonyms_str})",
+                                    "skip": page * LEMMA_PAGE_SIZE, "limit": LEMMA_PAGE_SIZE}
+
+
+def get_synsets_by_lemma_query(tx, lemma: str, page: int = 0) -> list[tuple]:
+    statement = synsets_by_lemma_statement(lemma, page)
+
+    if statement is None:
         return []
-    
-    rel_type = "IS_A>" if rtype == PredicateType.HYPERNYM else "PART_OF>"
-    rel_name = "rel = 'IS_A'" if rtype == PredicateType.HYPERNYM else "rel = 'PART_OF'"
-    dummy_rel = "`IS_A`" if rtype == PredicateType.HYPERNYM else "`PART_OF`"
-    match_entities = ""
-    with_entities = ""
-    merge_entities = ""
 
-    params = {}
+    return to_synset_records(run_statement(tx, *statement))
 
-    for i in range(0, len(terms)):
-        params["e"+str(i)] = terms[i]
-        match_entities += "MATCH (e" + str(i) + ":Synset {id:$e" + str(i) + "}) "
-        with_entities += "e" + str(i) + (", " if i < len(terms) - 1 else " ")
-        merge_entities += "MERGE (dummy)-[:" + dummy_rel + "]->(e" + str(i) + ") "
 
-    query = match_entities + "CREATE (dummy:Dummy) WITH dummy, " + with_entities + merge_entities + """ WITH dummy CALL apoc.path.subgraphAll(dummy, {uniqueness:'RELATIONSHIP_GLOBAL', relationshipFilter:'""" + rel_type + """'}) YIELD nodes, relationships UNWIND relationships as relation WITH dummy, startNode(relation).id as x, endNode(relation).id as y, type(relation) as rel WHERE x IS NOT null and """ + rel_name + """ DETACH DELETE dummy RETURN x, y; """
+def get_reached_synsets_query_batched(tx, terms: list, rel: str):
+    if DatasetManager().available_relations.get(rel, False):
+        return to_pairs(run_statement(tx, reached_synsets_statement(rel), {"terms": terms}), "source", "id")
 
-    result = tx.run(query,
-        parameters=params)
+    return []
 
-    subgraph = []
 
-    for record in result:
-        subgraph.append((record["x"], record["y"]))
+def get_reached_synsets_variable_query_batched(tx, terms: list, rel: str):
+    if DatasetManager().available_relations.get(rel, False):
+        return to_reached_map(run_statement(tx, reached_synsets_variable_statement(rel), {"terms": terms}), terms)
 
-    return subgraph
+    return {}
 
 
-def get_available_relations_query(tx):
-    result = tx.run("CALL db.relationshipTypes()")
+def get_bfs_tree_query_batched(tx, terms: list, rel: str, depth: int):
+    # BFS with global node uniqueness keeps, for every root, only the first (shortest) discovery of each node
+    return to_bfs_tree(run_statement(tx, BFS_TREE_QUERY, {"terms": terms, "filter": rel + ">", "depth": depth}))
 
-    relations = {}
 
-    for record in result:
-        relations[record["relationshipType"]] = True
+def get_reached_synsets_hypernym_query_batched(tx, terms: list):
+    return to_pairs(run_statement(tx, reached_synsets_statement("IS_A"), {"terms": terms}), "source", "id")
 
-    return relations
+
+def get_subgraphs_query(tx, terms: list, rtype:PredicateType):
+    params = subgraphs_params(terms, rtype)
+
+    if params is None:
+        return []
+
+    return to_pairs(run_statement(tx, SUBGRAPHS_QUERY, params), "x", "y")
+
+
+def get_available_relations_query(tx):
+    return to_available_relations(run_statement(tx, AVAILABLE_RELATIONS_QUERY))
 
 
 def get_synsets_by_cq_query(tx, query: str, params: dict):
-    result = tx.run(query, parameters=params)
+    return to_terms(run_statement(tx, query, params))
 
-    entities = []
 
-    for record in result:
-        entities.append(Term(record["id"]))
+def get_ids_by_cq_query(tx, query: str, params: dict) -> SortedIds:
+    return SortedIds(to_ids(run_statement(tx, query, params)))
 
-    return entities
 
+def get_id_lists_by_cq_query(tx, query: str, params: dict, columns: list[str]) -> list[list[str]]:
+    record = run_statement(tx, query, params).single()
+    return [list(record[column]) for column in columns]
 
-def get_synset_by_id_query(tx, _id) -> Term or None:
-    result = tx.run("MATCH (node:Synset {id: $id}) RETURN node.id as id, node.main_sense as main_sense, " +
-                    "node.synonyms as synonyms, node.description as description, node.image_url as image_url", id=_id)
-    record = result.single()
 
-    if record is None:
-        return None
+def get_profile_by_cq_query(tx, query: str, params: dict) -> dict:
+    result = run_statement(tx, query, params)
+    rows = len(list(result))
+    summary = result.consume()
+    plan = summary.profile if summary.profile is not None else summary.plan
 
-    return Term(record["id"],
-                babelnet_entity=BabelNetEntity(record["main_sense"], record["description"], record["synonyms"],
-                                              record["image_url"]))
+    return {"rows": rows, "available_after_ms": summary.result_available_after,
+            "consumed_after_ms": summary.result_consumed_after,
+            "operators": to_plan_operators(plan) if plan is not None else []}
 
 
-def get_synsets_by_id_query_batched(tx, terms) -> list[Term] or None:
-    result = tx.run("UNWIND $terms AS term MATCH (node:Synset {id: term}) RETURN node.id as id, node.main_sense as main_sense, " +
-                    "node.synonyms as synonyms, node.description as description, node.image_url as image_url", terms=terms)
-    
-    entities = []
+def get_count_query(tx, query: str, params: dict = None) -> int:
+    return run_statement(tx, query, params).single()["count"]
 
-    for record in result:
-        entities.append(Term(record["id"], babelnet_entity=BabelNetEntity(record["main_sense"], record["description"],
-                                                                         record["synonyms"], record["image_url"])))
 
-    return entities
+def has_answers_by_cq_query(tx, query: str, params: dict) -> bool:
+    return run_statement(tx, query, params).peek() is not None
+
+
+def get_synset_by_id_query(tx, _id) -> tuple or None:
+    record = run_statement(tx, SYNSET_BY_ID_QUERY, {"id": _id}).single()
+
+    if record is None:
+        return None
+
+    return synset_record(record)
+
+
+def get_synsets_by_id_query_batched(tx, terms) -> list[tuple]:
+    return to_synset_records(run_statement(tx, SYNSETS_BY_ID_BATCHED_QUERY, {"terms": terms}))
 
 
 def get_in_rank_by_id_query_batched(tx, terms) -> list[tuple[str, int, int]]:
-    result = tx.run("UNWIND $terms AS term MATCH (node:Synset {id: term}) RETURN node.id as id, node.hyperInRank as hyperInRank, " +
-                    "node.holonymInRank as holonymInRank", terms=terms)
-    
-    entities = []
+    return to_in_ranks(run_statement(tx, IN_RANK_BATCHED_QUERY, {"terms": terms}))
+
+
+def get_in_degree_query_batched(tx, pairs) -> dict[tuple[str, str], int]:
+    return to_in_degrees(run_statement(tx, IN_DEGREE_BATCHED_QUERY, {"pairs": pairs}))
+
+
+def get_env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        print(f'Invalid value for {name}, using {default}')
+        return default
+
+
+def get_env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        print(f'Invalid value for {name}, using {default}')
+        return default
+
+
+def driver_config() -> tuple[str, dict]:
+    return (os.environ.get('NEO4J_URI', "**********"),
+            {"auth": (os.environ.get('NEO4J_USER', "******"), os.environ.get('NEO4J_PASSWORD', "********")),
+             "max_connection_pool_size": get_env_int('NEO4J_MAX_POOL_SIZE', 100),
+             "connection_acquisition_timeout": get_env_float('NEO4J_ACQUISITION_TIMEOUT', 60.0),
+             "max_connection_lifetime": get_env_float('NEO4J_MAX_CONNECTION_LIFETIME', 3600.0)})
+
+
+def cycle_distances(_id: str, parents: dict[str, tuple], component: dict, bound: int) -> dict[str, int]:
+    # Distances within bound from _id to the members of its (cyclic) component through edges of the component, _id
+    # itself included with the length of its shortest cycle
+    distances = {}
+    frontier = [_id]
+    level = 0
+
+    while len(frontier) > 0 and level < bound:
+        level += 1
+        next_frontier = []
+        for node in frontier:
+            for parent in parents[node]:
+                if component.get(parent, -1) == component[_id] and parent not in distances:
+                    distances[parent] = level
+                    next_frontier.append(parent)
+        frontier = next_frontier
+
+    return distances
+
+
+def bounded_ancestor_depths(_id: str, inner: dict[str, int], parents: dict[str, tuple], component: dict,
+                            ancestors: dict[str, tuple[dict[str, int], bool]],
+                            bound: int) -> tuple[dict[str, int], bool]:
+    # Ancestors of _id within bound edges and whether none was left out. inner holds the distances to the members of
+    # its component (empty unless it lies on a cycle), the rest is composed from the maps of the parents leaving it
+    exits = {}
+    for node, distance in [(_id, 0)] + list(inner.items()):
+        for parent in parents[node]:
+            if component.get(parent, -1) != component[_id] and distance + 1 < exits.get(parent, bound + 2):
+                exits[parent] = distance + 1
+
+    # The map is complete if every ancestor only reached beyond the bound through some parent is also within the
+    # bound through another one (an incomplete parent map may hide farther ancestors, so it is never complete)
+    depths = dict(inner)
+    beyond = set()
+    complete = True
+    for parent, distance in exits.items():
+        if distance > bound:
+            beyond.add(parent)
+            continue
+        if distance < depths.get(parent, bound + 1):
+            depths[parent] = distance
 
-    for record in result:
-        entities.append((record["id"], record["hyperInRank"], record["holonymInRank"]))
+        parent_depths, parent_complete = ancestors[parent]
+        complete = complete and parent_complete
+        for ancestor, depth in parent_depths.items():
+            if distance + depth > bound:
+                beyond.add(ancestor)
+            elif distance + depth < depths.get(ancestor, bound + 1):
+                depths[ancestor] = distance + depth
 
-    return entities
+    return depths, complete and all(map(lambda ancestor: ancestor in depths, beyond))
 
 
 class SingletonMeta(type):
     _instances = {}
+    _lock = threading.RLock()
 
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
-            instance = super().__call__(*args, **kwargs)
-            cls._instances[cls] = instance
+            with cls._lock:
+                if cls not in cls._instances:
+                    instance = super().__call__(*args, **kwargs)
+                    cls._instances[cls] = instance
         return cls._instances[cls]
 
 
+class UnitOfWork:
+    def __init__(self, session) -> None:
+        self.session = session
+        self.tx = session.begin_transaction()
+
+    def close(self):
+        try:
+            self.tx.close()
+        finally:
+            self.session.close()
+
+
 class DatasetManager(metaclass=SingletonMeta):
     def __init__(self) -> None:
         self.default_depths = {PredicateType.HYPERNYM: 1, PredicateType.HOLONYM: 1, PredicateType.OTHER: 1}
         self.available_relations = {}
         self.relations_ranking = init_relation_ranking()
-        
-        self.driver = GraphDatabase.driver("**********", auth=("******", "********"))
+        self.fetch_size = get_env_int('NEO4J_FETCH_SIZE', 1000)
+        self._local = threading.local()
+        statement_stats.max_statements = get_env_int('STATEMENT_STATS_ENTRIES', 10000)
+
+        # Synset metadata never changes for a given dataset, so entries only expire if a ttl is configured
+        self.synset_cache = LRUCache(get_env_int('SYNSET_CACHE_ENTRIES', 200000),
+                                     get_env_int('SYNSET_CACHE_BYTES', 0),
+                                     get_env_float('SYNSET_CACHE_TTL', 0))
+        self.lemma_cache = LRUCache(get_env_int('LEMMA_CACHE_ENTRIES', 10000),
+                                    get_env_int('LEMMA_CACHE_BYTES', 0),
+                                    get_env_float('LEMMA_CACHE_TTL', 0))
+        # Read-only CSR export of (some) relations, when available neighbour queries on them never reach Neo4j
+        self.graph_snapshot = load_snapshot(os.environ.get('GRAPH_SNAPSHOT_DIR', None))
+        # Out-neighbour lists keyed by (relation, synset id), "*" marks transitive closures of a relation
+        self.adjacency_cache = LRUCache(get_env_int('ADJACENCY_CACHE_ENTRIES', 500000),
+                                        get_env_int('ADJACENCY_CACHE_BYTES', 256 * 1024 * 1024),
+                                        get_env_float('ADJACENCY_CACHE_TTL', 0))
+        # Ancestors of a synset within ancestor_depth edges with their distance, keyed by (relation, synset id), for
+        # IS_A and PART_OF only. They are shared by every algorithm walking up the taxonomies (see get_ancestor_depths)
+        self.ancestor_depth = max(get_env_int('ANCESTOR_CACHE_DEPTH', 20), 1)
+        self.ancestor_cache = LRUCache(get_env_int('ANCESTOR_CACHE_ENTRIES', 200000),
+                                       get_env_int('ANCESTOR_CACHE_BYTES', 256 * 1024 * 1024),
+                                       get_env_float('ANCESTOR_CACHE_TTL', 0))
+        # Compiled conjunctive queries keyed by formula fingerprint (see query_module.build_match_clauses_new)
+        self.query_plan_cache = LRUCache(get_env_int('QUERY_PLAN_CACHE_ENTRIES', 10000),
+                                         get_env_int('QUERY_PLAN_CACHE_BYTES', 0),
+                                         get_env_float('QUERY_PLAN_CACHE_TTL', 0))
+        # Optional materialisation of query answers, enabled by a byte budget. The dataset is static, so instead of
+        # expiring, entries are keyed by the dataset version and the ones of a previous version are just evicted
+        self.answer_cache = LRUCache(0, get_env_int('ANSWER_CACHE_BYTES', 0))
+        self.answer_cache_limit = get_env_int('ANSWER_CACHE_LIMIT', 10000)
+        self.dataset_version = os.environ.get('DATASET_VERSION', '')
+        self.count_timeout = get_env_float('QUERY_COUNT_TIMEOUT', 2.0)
+        # Summaries computed by AsyncDatasetManager instead of within the request unit of work
+        self.async_summaries = get_env_int('ASYNC_SUMMARIES', 0) > 0
+        # Relations whose descendant labels have been written on the nodes (graph_snapshot.py --write-labels)
+        self.interval_labels = set(filter(None, os.environ.get('INTERVAL_LABELS', '').split(',')))
+        self.synset_count = None
+
+        uri, config = driver_config()
+        self.driver = GraphDatabase.driver(uri, **config)
         try:
             self.driver.verify_connectivity()
             self.load_available_relations()
@@ -282,54 +497,334 @@ class DatasetManager(metaclass=SingletonMeta):
             self.driver.close()
             self.driver = None
 
+    def session(self):
+        # Sessions are not thread safe, so each waitress worker thread keeps its own one alive and reuses it,
+        # while the underlying connections come from the shared driver pool
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self.driver.session(fetch_size=self.fetch_size)
+            self._local.session = session
+        return session
+
+    def discard_session(self):
+        session = getattr(self._local, 'session', None)
+        self._local.session = None
+        if session is not None:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def unit_of_work(self) -> UnitOfWork or None:
+        # Within a Flask request every read shares a single session and read transaction, opened lazily by the
+        # first query and closed by close_unit_of_work when the request is torn down
+        if not has_request_context():
+            return None
+
+        unit_of_work = g.get('neo4j_unit_of_work', None)
+        if unit_of_work is None:
+            unit_of_work = UnitOfWork(self.driver.session(fetch_size=self.fetch_size, default_access_mode=READ_ACCESS))
+            g.neo4j_unit_of_work = unit_of_work
+        return unit_of_work
+
+    def close_unit_of_work(self):
+        if not has_request_context():
+            return
+
+        unit_of_work = g.pop('neo4j_unit_of_work', None)
+        if unit_of_work is not None:
+            try:
+                unit_of_work.close()
+            except Exception:
+                pass
+
+    def read(self, work, *args):
+        unit_of_work = self.unit_of_work()
+        if unit_of_work is not None:
+            try:
+                return work(unit_of_work.tx, *args)
+            except Exception:
+                # A failed transaction can not run further queries, the next read will open a new one
+                self.close_unit_of_work()
+                raise
+
+        try:
+            return self.session().execute_read(work, *args)
+        except Exception:
+            self.discard_session()
+            raise
+
+    def read_with_timeout(self, work, timeout: float, *args):
+        # Runs work in a transaction of its own (not the one of the request), which the server aborts after timeout
+        try:
+            return self.session().execute_read(unit_of_work(timeout=timeout)(work), *args)
+        except Exception:
+            self.discard_session()
+            raise
+
     def load_available_relations(self):
-        with self.driver.session() as session:
-            self.available_relations = session.read_transaction(get_available_relations_query)
+        self.available_relations = self.read(get_available_relations_query)
 
     def get_synsets_by_lemma(self, lemma: str, page: int) -> list[Term]:
-        with self.driver.session() as session:
-            return session.read_transaction(get_synsets_by_lemma_query, lemma, page)
+        key = (lemma, max(page, 0))
+        records = self.lemma_cache.get(key)
+
+        if records is None:
+            records = tuple(self.read(get_synsets_by_lemma_query, lemma, page))
+            self.lemma_cache.put(key, records)
+            self.synset_cache.put_many({record[0]: record for record in records})
+
+        return list(map(synset_record_to_term, records))
+
+    def reachability_index(self, relation: str) -> GraphSnapshot or None:
+        # The graph snapshot, if it has the reachability index of relation (see graph_snapshot.build_reachability)
+        if self.graph_snapshot is None or not self.graph_snapshot.has_reachability(relation):
+            return None
+        return self.graph_snapshot
+
+    def level_index(self, relation: str) -> GraphSnapshot or None:
+        # The graph snapshot, if it has the level labels of relation (see graph_snapshot.level_labels)
+        if self.graph_snapshot is None or not self.graph_snapshot.has_levels(relation):
+            return None
+        return self.graph_snapshot
+
+    def snapshot_adjacency(self, current_ids: list, relation: str, transitive: bool = False) -> dict[str, tuple] or None:
+        if self.graph_snapshot is None or not self.graph_snapshot.has_relation(relation):
+            return None
+
+        if transitive:
+            return {_id: tuple(self.graph_snapshot.reachable(relation, _id)) for _id in current_ids}
+        return {_id: tuple(self.graph_snapshot.neighbours(relation, _id)) for _id in current_ids}
+
+    def cached_adjacency(self, current_ids: list, relation: str, transitive: bool = False) -> tuple[dict, list]:
+        cache_relation = relation + "*" if transitive else relation
+        cached, missing = self.adjacency_cache.get_many([(cache_relation, _id) for _id in current_ids])
+        return {key[1]: neighbours for key, neighbours in cached.items()}, [key[1] for key in missing]
+
+    def store_adjacency(self, adjacency: dict, missing_ids: list, fetched: dict, relation: str, transitive: bool = False):
+        cache_relation = relation + "*" if transitive else relation
+
+        # Ids without records are cached too, as confirmed empty neighbourhoods
+        for _id in missing_ids:
+            neighbours = tuple(fetched.get(_id, ()))
+            self.adjacency_cache.put((cache_relation, _id), neighbours)
+            adjacency[_id] = neighbours
+
+        return adjacency
+
+    def get_adjacency_batched(self, current_ids: list, relation: str, transitive: bool = False) -> dict[str, tuple]:
+        adjacency = self.snapshot_adjacency(current_ids, relation, transitive)
+        if adjacency is not None:
+            return adjacency
+
+        adjacency, missing_ids = self.cached_adjacency(current_ids, relation, transitive)
+        if len(missing_ids) == 0:
+            return adjacency
+
+        if transitive:
+            fetched = self.read(get_reached_synsets_variable_query_batched, missing_ids, relation)
+        elif relation == "IS_A":
+            fetched = pairs_to_map(self.read(get_reached_synsets_hypernym_query_batched, missing_ids))
+        else:
+            fetched = pairs_to_map(self.read(get_reached_synsets_query_batched, missing_ids, relation))
+
+        return self.store_adjacency(adjacency, missing_ids, fetched, relation, transitive)
 
     def get_reached_synsets_by_relation(self, current_id: str, relation: str):
-        with self.driver.session() as session:
-            return session.read_transaction(get_reached_synsets_query, current_id, relation)
+        if not self.available_relations.get(relation, False):
+            return []
+        return list(self.get_adjacency_batched([current_id], relation)[current_id])
 
     def get_reached_synsets_by_relation_batched(self, current_ids: list, relation: str):
-        with self.driver.session() as session:
-            return session.read_transaction(get_reached_synsets_query_batched, current_ids, relation)
+        if not self.available_relations.get(relation, False):
+            return []
+        adjacency = self.get_adjacency_batched(current_ids, relation)
+        return [(_id, neighbour) for _id in current_ids for neighbour in adjacency[_id]]
         
     def get_reached_synsets_variable_by_relation_batched(self, current_ids: list, relation: str):
-        with self.driver.session() as session:
-            return session.read_transaction(get_reached_synsets_variable_query_batched, current_ids, relation)
+        if not self.available_relations.get(relation, False):
+            return {}
+        adjacency = self.get_adjacency_batched(current_ids, relation, transitive=True)
+        return {_id: list(adjacency[_id]) for _id in current_ids}
 
     def get_reached_synsets_by_hypernym(self, current_id: str):
-        with self.driver.session() as session:
-            return session.read_transaction(get_reached_synsets_hypernym_query, current_id)
+        return list(self.get_adjacency_batched([current_id], "IS_A")[current_id])
         
     def get_reached_synsets_by_hypernym_batched(self, current_ids: list):
-        with self.driver.session() as session:
-            return session.read_transaction(get_reached_synsets_hypernym_query_batched, current_ids)
+        adjacency = self.get_adjacency_batched(current_ids, "IS_A")
+        return [(_id, neighbour) for _id in current_ids for neighbour in adjacency[_id]]
+
+    def get_ancestor_depths(self, terms: list, relation: str) -> dict[str, tuple[dict[str, int], bool]]:
+        """
+        Maps every term to its ancestors under relation (synsets reached through at least one edge) within
+        ancestor_depth edges, with their distance, and to whether no farther ancestor exists, for the relations in
+        REACHABILITY_RELATIONS.
+        Only the synsets missing from ancestor_cache are visited, stopping at the cached ones. Cycles are condensed and
+        the synsets composed parents first from the maps of their parents, so every visited synset is composed once
+        and the maps of the popular upper levels are shared by later requests. Bounding the maps keeps their size
+        (and the composition) linear in the number of synsets on long chains.
+        The returned maps are shared with the cache and must not be modified.
+        """
+        ancestors = {}
+        parents = {}
+        cached, missing = self.ancestor_cache.get_many([(relation, term) for term in terms])
+        ancestors.update({key[1]: entry for key, entry in cached.items()})
+        frontier = [key[1] for key in missing]
+
+        while len(frontier) > 0:
+            if relation == "IS_A" or self.available_relations.get(relation, False):
+                parents.update(self.get_adjacency_batched(frontier, relation))
+            else:
+                parents.update({_id: () for _id in frontier})
+
+            reached = {parent for _id in frontier for parent in parents[_id]
+                       if parent not in parents and parent not in ancestors}
+            cached, missing = self.ancestor_cache.get_many([(relation, _id) for _id in reached])
+            ancestors.update({key[1]: entry for key, entry in cached.items()})
+            frontier = [key[1] for key in missing]
+
+        return self.compose_ancestor_depths(terms, relation, parents, ancestors)
+
+    def compose_ancestor_depths(self, terms: list, relation: str, parents: dict[str, tuple],
+                                ancestors: dict[str, tuple[dict[str, int], bool]]) -> dict[str, tuple[dict, bool]]:
+        # parents maps every visited synset to its parents, ancestors holds the cached maps the visit stopped at.
+        # Components are numbered in reverse topological order, that is parents first.
+        component = strongly_connected_components(
+            list(parents), lambda _id: [parent for parent in parents[_id] if parent in parents])
+        members = [[] for _ in range(len(set(component.values())))]
+        for _id in parents:
+            members[component[_id]].append(_id)
+
+        for group in members:
+            for _id in group:
+                inner = {}
+                if len(group) > 1 or _id in parents[_id]:
+                    # Every member of a cyclic component is reached, unless it lies beyond the bound
+                    inner = cycle_distances(_id, parents, component, self.ancestor_depth)
+                depths, complete = bounded_ancestor_depths(_id, inner, parents, component, ancestors,
+                                                           self.ancestor_depth)
+                ancestors[_id] = (depths, complete and (len(inner) == 0 or len(inner) == len(group)))
+
+        for _id in parents:
+            self.ancestor_cache.put((relation, _id), ancestors[_id])
+
+        return {term: ancestors[term] for term in terms}
+
+    def cached_ancestor_depths(self, terms: list, relation: str) -> dict[str, dict[str, int]] or None:
+        # Maps of get_ancestor_depths if all the terms are already memoised, without any traversal
+        cached, missing = self.ancestor_cache.get_many([(relation, term) for term in terms])
+        if len(missing) > 0:
+            return None
+        return {key[1]: entry[0] for key, entry in cached.items()}
+
+    def get_bfs_tree_batched(self, roots: list, relation: str, depth: int) -> list[tuple[str, str, str, int]]:
+        if relation != "IS_A" and not self.available_relations.get(relation, False):
+            return []
+
+        roots = list(dict.fromkeys(roots))
+        if self.graph_snapshot is None or not self.graph_snapshot.has_relation(relation):
+            return self.read(get_bfs_tree_query_batched, roots, relation, depth)
+
+        return self.snapshot_bfs_tree(roots, relation, depth)
+
+    def snapshot_bfs_tree(self, roots: list, relation: str, depth: int) -> list[tuple[str, str, str, int]]:
+        tree = []
+        for root in roots:
+            reached = {root}
+            frontier = [root]
+            for level in range(1, depth + 1):
+                adjacency = self.snapshot_adjacency(frontier, relation)
+                next_frontier = []
+                for parent in frontier:
+                    for node in adjacency[parent]:
+                        if node not in reached:
+                            reached.add(node)
+                            next_frontier.append(node)
+                            tree.append((root, node, parent, level))
+                if len(next_frontier) == 0:
+                    break
+                frontier = next_frontier
+
+        return tree
 
     def get_summary_config(self, synset_id: str) -> list[SummaryConfigEntry]:
-        with self.driver.session() as session:
-            return session.read_transaction(get_summary_config_query, synset_id)
+        return self.read(get_summary_config_query, synset_id)
 
     def get_synsets_by_cq(self, query: str, params: dict):
-        with self.driver.session() as session:
-            return session.read_transaction(get_synsets_by_cq_query, query, params)
+        return self.read(get_synsets_by_cq_query, query, params)
+
+    def get_ids_by_cq(self, query: str, params: dict) -> SortedIds:
+        return self.read(get_ids_by_cq_query, query, params)
+
+    def get_id_lists_by_cq(self, query: str, params: dict, columns: list[str]) -> list[list[str]]:
+        return self.read(get_id_lists_by_cq_query, query, params, columns)
+
+    def get_profile_by_cq(self, query: str, params: dict) -> dict:
+        return self.read(get_profile_by_cq_query, query, params)
+
+    def get_count_by_cq(self, query: str, params: dict, timeout: float) -> int or None:
+        # None if counting takes longer than timeout seconds
+        try:
+            return self.read_with_timeout(get_count_query, timeout, query, params)
+        except Neo4jError as e:
+            if e.code is not None and 'TransactionTimedOut' in e.code:
+                return None
+            raise
+
+    def get_synset_count(self) -> int:
+        # Answered by the count store, it is only read once
+        if self.synset_count is None:
+            self.synset_count = self.read(get_count_query, SYNSET_COUNT_QUERY)
+        return self.synset_count
+
+    def has_answers_by_cq(self, query: str, params: dict) -> bool:
+        return self.read(has_answers_by_cq_query, query, params)
 
     def get_synset_by_id(self, _id: str) -> Term:
-        with self.driver.session() as session:
-            return session.read_transaction(get_synset_by_id_query, _id)
+        record = self.synset_cache.get(_id)
+
+        if record is None:
+            record = self.read(get_synset_by_id_query, _id)
+            if record is None:
+                return None
+            self.synset_cache.put(_id, record)
+
+        return synset_record_to_term(record)
         
+    def store_synset_records(self, records: dict, fetched: list[tuple]) -> dict:
+        fetched = {record[0]: record for record in fetched}
+        self.synset_cache.put_many(fetched)
+        records.update(fetched)
+        return records
+
     def get_synsets_by_id_batched(self, terms: list[str]) -> list[Term]:
-        with self.driver.session() as session:
-            return session.read_transaction(get_synsets_by_id_query_batched, terms)
+        records, missing = self.synset_cache.get_many(terms)
+
+        if len(missing) > 0:
+            self.store_synset_records(records, self.read(get_synsets_by_id_query_batched, missing))
+
+        return [synset_record_to_term(records[term]) for term in terms if term in records]
         
     def get_in_rank_by_id_batched(self, terms: list[str]) -> list[tuple[str, int, int]]:
-        with self.driver.session() as session:
-            return session.read_transaction(get_in_rank_by_id_query_batched, terms)
+        return self.read(get_in_rank_by_id_query_batched, terms)
+
+    def get_in_degree_batched(self, pairs: list[list[str]]) -> dict[tuple[str, str], int]:
+        # Incoming edges of each [synset id, relation] pair, synsets missing from the dataset have a degree of 0
+        degrees = {(pair[0], pair[1]): 0 for pair in pairs}
+        degrees.update(self.read(get_in_degree_query_batched, pairs))
+        return degrees
         
+    def snapshot_subgraphs(self, terms: list[str], rtype:PredicateType) -> list[tuple[str, str]] or None:
+        relation = "IS_A" if rtype == PredicateType.HYPERNYM else "PART_OF"
+        if (rtype in [PredicateType.HYPERNYM, PredicateType.HOLONYM] and self.graph_snapshot is not None
+                and self.graph_snapshot.has_relation(relation)):
+            return self.graph_snapshot.subgraph(relation, terms)
+
+        return None
+
     def get_subgraphs(self, terms: list[str], rtype:PredicateType) -> list[tuple[str, str]]:
-        with self.driver.session() as session:
-            return session.write_transaction(get_subgraphs_query, terms, rtype)
+        subgraph = self.snapshot_subgraphs(terms, rtype)
+        if subgraph is not None:
+            return subgraph
+
+        return self.read(get_subgraphs_query, terms, rtype)
@@ -0,0 +1,187 @@
+import asyncio
+import threading
+
+from neo4j import AsyncGraphDatabase, READ_ACCESS
+
+from eXsim.babelnet import *
+
+
+async def fetch_records(tx, query: str, params: dict) -> list:
+    statement_stats.record(query)
+    result = await tx.run(query, parameters=params)
+    return [record async for record in result]
+
+
+class AsyncDatasetManager(metaclass=SingletonMeta):
+    """
+    Asynchronous counterpart of DatasetManager, backed by the neo4j AsyncGraphDatabase driver.
+    All coroutines run on a single event loop owned by a background thread, so independent lookups of a request can
+    be awaited concurrently with asyncio.gather. The calling thread still waits for the whole coroutine, and every
+    read runs in a session of its own rather than in the request unit of work, so it is only used for summaries when
+    ASYNC_SUMMARIES is set.
+    Caches, graph snapshot and relation metadata are shared with the synchronous DatasetManager.
+    """
+
+    def __init__(self) -> None:
+        self.dataset_manager = DatasetManager()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='neo4j-async', daemon=True)
+        self.thread.start()
+        self.driver = self.run(self.connect())
+
+    async def connect(self):
+        uri, config = driver_config()
+        driver = AsyncGraphDatabase.driver(uri, **config)
+        try:
+            await driver.verify_connectivity()
+        except Exception:
+            await driver.close()
+            driver = None
+        return driver
+
+    def run(self, coroutine):
+        # Blocks the calling (waitress) thread until the coroutine has been completed by the event loop thread
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def offload(self, function, *args):
+        # CPU bound work (snapshot traversals, record mapping, cache size estimates) runs on the default executor,
+        # so that it does not hold the event loop shared by the summaries of every request
+        return await self.loop.run_in_executor(None, function, *args)
+
+    async def read(self, query: str, params: dict) -> list:
+        async with self.driver.session(fetch_size=self.dataset_manager.fetch_size,
+                                       default_access_mode=READ_ACCESS) as session:
+            return await session.execute_read(fetch_records, query, params)
+
+    async def read_mapped(self, mapper, query: str, params: dict):
+        return await self.offload(mapper, await self.read(query, params))
+
+    async def get_synsets_by_lemma(self, lemma: str, page: int) -> list[Term]:
+        key = (lemma, max(page, 0))
+        records = self.dataset_manager.lemma_cache.get(key)
+
+        if records is None:
+            statement = synsets_by_lemma_statement(lemma, page)
+            records = () if statement is None else tuple(await self.read_mapped(to_synset_records, *statement))
+            await self.offload(self.store_lemma_records, key, records)
+
+        return list(map(synset_record_to_term, records))
+
+    def store_lemma_records(self, key: tuple, records: tuple):
+        self.dataset_manager.lemma_cache.put(key, records)
+        self.dataset_manager.synset_cache.put_many({record[0]: record for record in records})
+
+    async def get_adjacency_batched(self, current_ids: list, relation: str, transitive: bool = False) -> dict[str, tuple]:
+        adjacency = await self.offload(self.dataset_manager.snapshot_adjacency, current_ids, relation, transitive)
+        if adjacency is not None:
+            return adjacency
+
+        adjacency, missing_ids = self.dataset_manager.cached_adjacency(current_ids, relation, transitive)
+        if len(missing_ids) == 0:
+            return adjacency
+
+        if transitive:
+            fetched = await self.read_mapped(lambda records: to_reached_map(records, missing_ids),
+                                             reached_synsets_variable_statement(relation), {"terms": missing_ids})
+        else:
+            fetched = await self.read_mapped(lambda records: pairs_to_map(to_pairs(records, "source", "id")),
+                                             reached_synsets_statement(relation), {"terms": missing_ids})
+
+        return await self.offload(self.dataset_manager.store_adjacency, adjacency, missing_ids, fetched, relation,
+                                  transitive)
+
+    async def get_ancestor_depths(self, terms: list, relation: str) -> dict[str, tuple[dict[str, int], bool]]:
+        # Same visit of DatasetManager.get_ancestor_depths, with the parents fetched on the event loop
+        ancestors = {}
+        parents = {}
+        cached, missing = self.dataset_manager.ancestor_cache.get_many([(relation, term) for term in terms])
+        ancestors.update({key[1]: entry for key, entry in cached.items()})
+        frontier = [key[1] for key in missing]
+
+        while len(frontier) > 0:
+            if relation == "IS_A" or self.dataset_manager.available_relations.get(relation, False):
+                parents.update(await self.get_adjacency_batched(frontier, relation))
+            else:
+                parents.update({_id: () for _id in frontier})
+
+            reached = {parent for _id in frontier for parent in parents[_id]
+                       if parent not in parents and parent not in ancestors}
+            cached, missing = self.dataset_manager.ancestor_cache.get_many([(relation, _id) for _id in reached])
+            ancestors.update({key[1]: entry for key, entry in cached.items()})
+            frontier = [key[1] for key in missing]
+
+        return await self.offload(self.dataset_manager.compose_ancestor_depths, terms, relation, parents, ancestors)
+
+    async def get_reached_synsets_by_relation(self, current_id: str, relation: str):
+        if not self.dataset_manager.available_relations.get(relation, False):
+            return []
+        return list((await self.get_adjacency_batched([current_id], relation))[current_id])
+
+    async def get_reached_synsets_by_relation_batched(self, current_ids: list, relation: str):
+        if not self.dataset_manager.available_relations.get(relation, False):
+            return []
+        adjacency = await self.get_adjacency_batched(current_ids, relation)
+        return [(_id, neighbour) for _id in current_ids for neighbour in adjacency[_id]]
+
+    async def get_reached_synsets_variable_by_relation_batched(self, current_ids: list, relation: str):
+        if not self.dataset_manager.available_relations.get(relation, False):
+            return {}
+        adjacency = await self.get_adjacency_batched(current_ids, relation, transitive=True)
+        return {_id: list(adjacency[_id]) for _id in current_ids}
+
+    async def get_reached_synsets_by_hypernym(self, current_id: str):
+        return list((await self.get_adjacency_batched([current_id], "IS_A"))[current_id])
+
+    async def get_reached_synsets_by_hypernym_batched(self, current_ids: list):
+        adjacency = await self.get_adjacency_batched(current_ids, "IS_A")
+        return [(_id, neighbour) for _id in current_ids for neighbour in adjacency[_id]]
+
+    async def get_bfs_tree_batched(self, roots: list, relation: str, depth: int) -> list[tuple[str, str, str, int]]:
+        if relation != "IS_A" and not self.dataset_manager.available_relations.get(relation, False):
+            return []
+
+        roots = list(dict.fromkeys(roots))
+        if self.dataset_manager.graph_snapshot is not None and self.dataset_manager.graph_snapshot.has_relation(relation):
+            return await self.offload(self.dataset_manager.snapshot_bfs_tree, roots, relation, depth)
+
+        return await self.read_mapped(to_bfs_tree, BFS_TREE_QUERY,
+                                      {"terms": roots, "filter": relation + ">", "depth": depth})
+
+    async def get_summary_config(self, synset_id: str) -> list[SummaryConfigEntry]:
+        return await self.read_mapped(to_summary_config_entries, SUMMARY_CONFIG_QUERY, {"id": synset_id})
+
+    async def get_synsets_by_cq(self, query: str, params: dict):
+        return await self.read_mapped(to_terms, query, params)
+
+    async def get_synset_by_id(self, _id: str) -> Term:
+        terms = await self.get_synsets_by_id_batched([_id])
+        return terms[0] if len(terms) > 0 else None
+
+    async def get_synsets_by_id_batched(self, terms: list[str]) -> list[Term]:
+        records, missing = self.dataset_manager.synset_cache.get_many(terms)
+
+        if len(missing) > 0:
+            await self.offload(self.dataset_manager.store_synset_records, records,
+                               await self.read_mapped(to_synset_records, SYNSETS_BY_ID_BATCHED_QUERY,
+                                                      {"terms": missing}))
+
+        return [synset_record_to_term(records[term]) for term in terms if term in records]
+
+    async def get_in_rank_by_id_batched(self, terms: list[str]) -> list[tuple[str, int, int]]:
+        return await self.read_mapped(to_in_ranks, IN_RANK_BATCHED_QUERY, {"terms": terms})
+
+    async def get_in_degree_batched(self, pairs: list[list[str]]) -> dict[tuple[str, str], int]:
+        degrees = {(pair[0], pair[1]): 0 for pair in pairs}
+        degrees.update(await self.read_mapped(to_in_degrees, IN_DEGREE_BATCHED_QUERY, {"pairs": pairs}))
+        return degrees
+
+    async def get_subgraphs(self, terms: list[str], rtype: PredicateType) -> list[tuple[str, str]]:
+        subgraph = await self.offload(self.dataset_manager.snapshot_subgraphs, terms, rtype)
+        if subgraph is not None:
+            return subgraph
+
+        params = subgraphs_params(terms, rtype)
+        if params is None:
+            return []
+
+        return await self.read_mapped(lambda records: to_pairs(records, "x", "y"), SUBGRAPHS_QUERY, params)
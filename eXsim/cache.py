@@ -0,0 +1,161 @@
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+
+def estimate_size(value) -> int:
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += estimate_size(key) + estimate_size(item)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += estimate_size(item)
+
+    return size
+
+
+class LRUCache:
+    """
+    Thread safe in-process cache with least recently used eviction.
+    It can be bounded by number of entries, by an estimate of the stored bytes or both (0 means unbounded),
+    and entries can optionally expire after ttl seconds.
+    """
+
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0, ttl: float = 0, sizeof=estimate_size) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _lookup(self, key):
+        entry = self.entries.get(key, None)
+
+        if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+            self._remove(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry[1]
+
+    def _evict(self):
+        while len(self.entries) > 0 and ((0 < self.max_entries < len(self.entries))
+                                         or (0 < self.max_bytes < self.size)):
+            entry = self.entries.popitem(last=False)[1]
+            self.size -= entry[1]
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._lookup(key)
+            return default if entry is None else entry[0]
+
+    def get_many(self, keys) -> tuple[dict, list]:
+        found = {}
+        missing = []
+        missing_keys = set()
+
+        with self.lock:
+            for key in keys:
+                if key in found or key in missing_keys:
+                    continue
+                entry = self._lookup(key)
+                if entry is None:
+                    missing_keys.add(key)
+                    missing.append(key)
+                else:
+                    found[key] = entry[0]
+
+        return found, missing
+
+    def put(self, key, value) -> bool:
+        # False when the entry alone exceeds max_bytes and was not stored
+        size = self.sizeof(key) + self.sizeof(value) if self.max_bytes > 0 else 0
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            if 0 < self.max_bytes < size:
+                return False
+
+            self.entries[key] = (value, size, expires_at)
+            self.size += size
+            self._evict()
+            return True
+
+    def put_many(self, items: dict):
+        for key, value in items.items():
+            self.put(key, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+class SortedIds:
+    """
+    Immutable sorted sequence of distinct ids, packed in a single utf-8 buffer plus offsets.
+    It takes a fraction of the memory of a list of str and it can be searched with bisect.
+    """
+
+    def __init__(self, ids) -> None:
+        data = bytearray()
+        self.offsets = array('I', [0])
+
+        for _id in sorted(set(ids)):
+            data += _id.encode('utf-8')
+            self.offsets.append(len(data))
+
+        self.data = bytes(data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('SortedIds index out of range')
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __contains__(self, _id: str):
+        i = bisect_left(self, _id)
+        return i < len(self) and self[i] == _id
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.data) + sys.getsizeof(self.offsets)
+
+    def index_after(self, _id: str) -> int:
+        return bisect_right(self, _id)
@@ -11,8 +11,10 @@ class HomContext:
         self.u2 = u2
 
 
-def execute_clingo_program(program: str) -> bool:
-    ctl = clingo.Control()
+def execute_clingo_program(program: str, quiet: bool = False) -> bool:
+    # quiet drops the grounder warnings (e.g. atoms not occurring in any rule head), which are expected for the
+    # programs built on every query containment check
+    ctl = clingo.Control(message_limit=0) if quiet else clingo.Control()
     ctl.add("base", [], program)
     ctl.ground([("base", [])], context=HomContext())
 
@@ -153,6 +155,17 @@ def classical_hom(add_info: list) -> str:
     return program
 
 
+def consistent_hom(add_info: list) -> str:
+    # classical_hom maps every atom on its own, here each term is also required to have a single image, as needed
+    # when bound variables are shared among atoms
+    program = classical_hom(add_info)
+    program += 'term_map(S,S1) :- map(A,B), atom("a",A,_,S,_), atom("b",B,_,S1,_)' + ENDLINE
+    program += 'term_map(D,D1) :- map(A,B), atom("a",A,_,_,D), atom("b",B,_,_,D1)' + ENDLINE
+    program += ':- term_map(T,T1), term_map(T,T2), T1 != T2' + ENDLINE
+
+    return program
+
+
 def unit_comparison_workflow(u1: Unit, u2: Unit) -> UnitRelation:
     left = False
     right = False
@@ -0,0 +1,524 @@
+import itertools
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+# This module only depends on the standard library (and on the neo4j driver for the build step), so that it can be
+# run as a script without starting the application:
+#
+#   NEO4J_URI=... NEO4J_USER=... NEO4J_PASSWORD=... python eXsim/graph_snapshot.py <output_dir> [--all | REL ...]
+#
+# A snapshot directory contains:
+#   manifest.json               node count, byte order and edge count of each exported relation
+#   ids.bin, ids.idx            sorted synset ids (utf-8, concatenated) and their offsets (uint64, nodes + 1)
+#   <REL>.indptr, <REL>.indices CSR arrays of the relation (uint64 row pointers, uint32 column indices)
+#
+# Taxonomic relations (IS_A and PART_OF) also get a reachability index, see build_reachability:
+#   <REL>.scc                   strongly connected component of each node (uint32), numbered in DFS post-order
+#   <REL>.members.indptr, .members  nodes of each component (uint64 pointers, uint32 node indices)
+#   <REL>.labels.indptr, .labels    components reachable from each component, as sorted disjoint intervals
+#                                   (uint64 pointers, uint32 lo/hi pairs)
+#   <REL>.levels, <REL>.depths  longest and shortest distance of each component from a root (uint32), where roots are
+#                                   the components without outgoing edges (the tops of a taxonomy)
+#   <REL>.roots.indptr, .roots  roots reachable from each component, itself included (uint64 pointers, uint32)
+#
+# The same labels of the reversed relations can be written on the :Synset nodes (--write-labels), so that Cypher
+# checks descendants with range comparisons instead of path expansions.
+
+SNAPSHOT_VERSION = 1
+DEFAULT_RELATIONS = ["IS_A", "PART_OF"]
+REACHABILITY_RELATIONS = ["IS_A", "PART_OF"]
+# Properties of the :Synset nodes holding the descendant labels of a relation, see write_interval_labels
+INTERVAL_LABEL_PROPERTIES = {"IS_A": ("hyperPost", "hyperIntervals"), "PART_OF": ("holonymPost", "holonymIntervals")}
+_UNSET = 0xFFFFFFFF
+
+
+def _write_array(path: str, values: array):
+    # Replaced atomically, a running application may still have the previous version mapped
+    with open(path + '.tmp', 'wb') as f:
+        values.tofile(f)
+    os.replace(path + '.tmp', path)
+
+
+def build_snapshot(driver, path: str, relations: list[str] = None, fetch_size: int = 10000) -> dict:
+    os.makedirs(path, exist_ok=True)
+
+    with driver.session(fetch_size=fetch_size) as session:
+        available = set(map(lambda record: record["relationshipType"],
+                            session.run("CALL db.relationshipTypes()").data()))
+        if relations is None:
+            relations = sorted(available)
+        relations = [relation for relation in relations if relation in available]
+
+        ids = sorted(record["id"] for record in session.run("MATCH (n:Synset) RETURN n.id AS id"))
+        index = {_id: i for i, _id in enumerate(ids)}
+
+        offsets = array('Q', [0])
+        with open(os.path.join(path, 'ids.bin'), 'wb') as f:
+            for _id in ids:
+                encoded = _id.encode('utf-8')
+                f.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+        _write_array(os.path.join(path, 'ids.idx'), offsets)
+        del ids
+
+        manifest = {"version": SNAPSHOT_VERSION, "byteorder": sys.byteorder, "nodes": len(index), "relations": {}}
+
+        for relation in relations:
+            sources = array('I')
+            targets = array('I')
+            result = session.run("MATCH (a:Synset)-[:`" + relation + "`]->(b:Synset) RETURN a.id AS source, b.id AS target")
+            for record in result:
+                sources.append(index[record["source"]])
+                targets.append(index[record["target"]])
+
+            # Counting sort of the edge list by source
+            indptr = array('Q', bytes(8 * (len(index) + 1)))
+            for source in sources:
+                indptr[source + 1] += 1
+            for i in range(len(index)):
+                indptr[i + 1] += indptr[i]
+
+            indices = array('I', bytes(4 * len(targets)))
+            cursor = array('Q', indptr[:-1])
+            for source, target in zip(sources, targets):
+                indices[cursor[source]] = target
+                cursor[source] += 1
+
+            _write_array(os.path.join(path, relation + '.indptr'), indptr)
+            _write_array(os.path.join(path, relation + '.indices'), indices)
+            manifest["relations"][relation] = len(indices)
+
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+
+class _IdTable:
+    # Sequence view over the sorted ids, so that bisect can search them without materialising a dict
+
+    def __init__(self, data: memoryview, offsets: memoryview) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+
+class GraphSnapshot:
+
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+
+        if self.manifest.get("version") != SNAPSHOT_VERSION or self.manifest.get("byteorder") != sys.byteorder:
+            raise ValueError(f'Incompatible graph snapshot in {path}')
+
+        self.path = path
+        self.ids = _IdTable(self._map('ids.bin', 'B'), self._map('ids.idx', 'Q'))
+        self.relations = {}
+
+        for relation in self.manifest["relations"]:
+            self.relations[relation] = (self._map(relation + '.indptr', 'Q'), self._map(relation + '.indices', 'I'))
+
+        self.reachability = {}
+        for relation in self.manifest.get("reachability", {}):
+            self.reachability[relation] = (self._map(relation + '.scc', 'I'),
+                                           self._map(relation + '.members.indptr', 'Q'),
+                                           self._map(relation + '.members', 'I'),
+                                           self._map(relation + '.labels.indptr', 'Q'),
+                                           self._map(relation + '.labels', 'I'))
+
+        # Level labels were added after the reachability index, snapshots built before just lack them
+        self.levels = {}
+        for relation, entry in self.manifest.get("reachability", {}).items():
+            if "roots" in entry:
+                self.levels[relation] = (self._map(relation + '.levels', 'I'), self._map(relation + '.depths', 'I'),
+                                         self._map(relation + '.roots.indptr', 'Q'), self._map(relation + '.roots', 'I'))
+
+    def _map(self, name: str, fmt: str) -> memoryview:
+        with open(os.path.join(self.path, name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(array(fmt))
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return memoryview(mapped).cast(fmt)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def has_relation(self, relation: str) -> bool:
+        return relation in self.relations
+
+    def index_of(self, _id: str) -> int:
+        i = bisect_left(self.ids, _id)
+        if i < len(self.ids) and self.ids[i] == _id:
+            return i
+        return -1
+
+    def id_at(self, i: int) -> str:
+        return self.ids[i]
+
+    def neighbour_indices(self, relation: str, i: int) -> memoryview:
+        indptr, indices = self.relations[relation]
+        return indices[indptr[i]:indptr[i + 1]]
+
+    def neighbours(self, relation: str, _id: str) -> list[str]:
+        i = self.index_of(_id)
+        if i < 0:
+            return []
+        return [self.ids[j] for j in self.neighbour_indices(relation, i)]
+
+    def has_reachability(self, relation: str) -> bool:
+        return relation in self.reachability
+
+    def reaches_index(self, relation: str, i: int, j: int) -> bool:
+        # Whether j can be reached from i through at least one edge, by a binary search on the label of i
+        component, _, _, labels_indptr, labels = self.reachability[relation]
+        label = labels[labels_indptr[component[i]]:labels_indptr[component[i] + 1]]
+        k = bisect_right(label[::2], component[j]) - 1
+        return k >= 0 and component[j] <= label[2 * k + 1]
+
+    def reaches(self, relation: str, source: str, target: str) -> bool:
+        i = self.index_of(source)
+        j = self.index_of(target)
+        return i >= 0 and j >= 0 and self.reaches_index(relation, i, j)
+
+    def has_levels(self, relation: str) -> bool:
+        return relation in self.levels
+
+    def level(self, relation: str, i: int) -> int:
+        return self.levels[relation][0][self.reachability[relation][0][i]]
+
+    def depth(self, relation: str, i: int) -> int:
+        return self.levels[relation][1][self.reachability[relation][0][i]]
+
+    def ancestor_roots(self, relation: str, i: int) -> set[int]:
+        # Roots reachable from i through at least one edge: a root itself reaches only its own component, if cyclic
+        c = self.reachability[relation][0][i]
+        _, _, roots_indptr, roots = self.levels[relation]
+        if self.levels[relation][0][c] == 0 and not self.reaches_index(relation, i, i):
+            return set()
+        return set(roots[roots_indptr[c]:roots_indptr[c + 1]])
+
+    def reachable_indices(self, relation: str, start: list[int]) -> list[int]:
+        if relation in self.reachability:
+            component, members_indptr, members, labels_indptr, labels = self.reachability[relation]
+            intervals = []
+            for i in start:
+                label = labels[labels_indptr[component[i]]:labels_indptr[component[i] + 1]]
+                intervals.extend(zip(label[::2], label[1::2]))
+
+            reached = []
+            for lo, hi in _merge_intervals(intervals):
+                reached.extend(members[members_indptr[lo]:members_indptr[hi + 1]])
+            return reached
+
+        reached = set()
+        frontier = list(start)
+
+        while len(frontier) > 0:
+            next_frontier = []
+            for i in frontier:
+                for j in self.neighbour_indices(relation, i):
+                    if j not in reached:
+                        reached.add(j)
+                        next_frontier.append(j)
+            frontier = next_frontier
+
+        return list(reached)
+
+    def reachable(self, relation: str, _id: str) -> list[str]:
+        i = self.index_of(_id)
+        if i < 0:
+            return []
+        return [self.ids[j] for j in self.reachable_indices(relation, [i])]
+
+    def subgraph(self, relation: str, _ids: list[str]) -> list[tuple[str, str]]:
+        seeds = [i for i in map(self.index_of, _ids) if i >= 0]
+        nodes = set(seeds).union(self.reachable_indices(relation, seeds))
+
+        edges = []
+        for i in nodes:
+            source = self.ids[i]
+            for j in self.neighbour_indices(relation, i):
+                edges.append((source, self.ids[j]))
+
+        return edges
+
+
+def _merge_intervals(intervals: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for lo, hi in sorted(intervals):
+        if len(merged) > 0 and lo <= merged[-1][1] + 1:
+            if hi > merged[-1][1]:
+                merged[-1] = (merged[-1][0], hi)
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def closure_labels(nodes: int, indptr, indices) -> tuple[array, array, array, array, array]:
+    """
+    Interval labelling of the transitive closure of the graph in CSR form (indptr, indices).
+    Cycles are condensed first (iterative Tarjan): every node of a strongly connected component shares its label and
+    reaches itself iff the component is cyclic. Components are numbered in completion order, that is a post-order of
+    the DFS over the condensation, so the components found below one of them in the DFS form a single interval and
+    the label of a component is the union of the labels of its successors plus the successors themselves, which
+    merges into a handful of intervals on taxonomy-like graphs.
+    Returns the component of each node, the members of each component and the labels (flattened lo/hi pairs), both
+    as CSR arrays.
+    """
+    order = array('I', [_UNSET]) * nodes
+    low = array('I', bytes(4 * nodes))
+    component = array('I', [_UNSET]) * nodes
+    members_indptr = array('Q', [0])
+    members = array('I')
+    labels_indptr = array('Q', [0])
+    labels = array('I')
+    stack = array('I')
+    work_nodes = array('I')
+    work_edges = array('Q')
+    visited = 0
+
+    # DFS roots are the sources (the leaves of a taxonomy) first: ancestor chains are then completed one right
+    # after the other and labels collapse into few intervals
+    in_degree = array('I', bytes(4 * nodes))
+    for target in indices:
+        in_degree[target] += 1
+    roots = [i for i in range(nodes) if in_degree[i] == 0]
+    del in_degree
+
+    for root in itertools.chain(roots, range(nodes)):
+        if order[root] != _UNSET:
+            continue
+
+        order[root] = low[root] = visited
+        visited += 1
+        stack.append(root)
+        work_nodes.append(root)
+        work_edges.append(indptr[root])
+
+        while len(work_nodes) > 0:
+            node = work_nodes[-1]
+            edge = work_edges[-1]
+            end = indptr[node + 1]
+
+            while edge < end:
+                neighbour = indices[edge]
+                edge += 1
+                if order[neighbour] == _UNSET:
+                    work_edges[-1] = edge
+                    order[neighbour] = low[neighbour] = visited
+                    visited += 1
+                    stack.append(neighbour)
+                    work_nodes.append(neighbour)
+                    work_edges.append(indptr[neighbour])
+                    break
+                if component[neighbour] == _UNSET and order[neighbour] < low[node]:
+                    low[node] = order[neighbour]
+            else:
+                work_nodes.pop()
+                work_edges.pop()
+                if len(work_nodes) > 0 and low[node] < low[work_nodes[-1]]:
+                    low[work_nodes[-1]] = low[node]
+
+                if low[node] == order[node]:
+                    current = len(members_indptr) - 1
+                    start = len(members)
+                    while True:
+                        member = stack.pop()
+                        component[member] = current
+                        members.append(member)
+                        if member == node:
+                            break
+                    members_indptr.append(len(members))
+
+                    # Every successor component is already labelled, since it was completed before this one
+                    intervals = []
+                    for member in members[start:]:
+                        for neighbour in indices[indptr[member]:indptr[member + 1]]:
+                            successor = component[neighbour]
+                            if successor == current:
+                                intervals.append((current, current))
+                            else:
+                                intervals.append((successor, successor))
+                                for i in range(labels_indptr[successor], labels_indptr[successor + 1], 2):
+                                    intervals.append((labels[i], labels[i + 1]))
+
+                    for lo, hi in _merge_intervals(intervals):
+                        labels.append(lo)
+                        labels.append(hi)
+                    labels_indptr.append(len(labels))
+
+    return component, members_indptr, members, labels_indptr, labels
+
+
+def level_labels(indptr, indices, component, members_indptr, members) -> tuple[array, array, array, array]:
+    """
+    Topological level (longest distance from a root), depth (shortest distance from a root) and reachable roots of
+    every component, computed on the condensation returned by closure_labels: components are numbered in post-order,
+    so the successors of a component always come before it.
+    """
+    components = len(members_indptr) - 1
+    levels = array('I', bytes(4 * components))
+    depths = array('I', bytes(4 * components))
+    roots_indptr = array('Q', [0])
+    roots = array('I')
+
+    for current in range(components):
+        successors = set()
+        for member in members[members_indptr[current]:members_indptr[current + 1]]:
+            for neighbour in indices[indptr[member]:indptr[member + 1]]:
+                if component[neighbour] != current:
+                    successors.add(component[neighbour])
+
+        if len(successors) == 0:
+            roots.append(current)
+        else:
+            levels[current] = 1 + max(levels[successor] for successor in successors)
+            depths[current] = 1 + min(depths[successor] for successor in successors)
+            reached = set()
+            for successor in successors:
+                reached.update(roots[roots_indptr[successor]:roots_indptr[successor + 1]])
+            roots.extend(sorted(reached))
+        roots_indptr.append(len(roots))
+
+    return levels, depths, roots_indptr, roots
+
+
+def build_reachability(path: str, relations: list[str] = None) -> dict:
+    """
+    Writes the closure labels of the given relations of the snapshot in path.
+    Labels hold the components reachable through at least one edge, so an ancestor test is a binary search on them
+    and ancestor sets are enumerated without any traversal.
+    """
+    snapshot = GraphSnapshot(path)
+    relations = [relation for relation in (REACHABILITY_RELATIONS if relations is None else relations)
+                 if snapshot.has_relation(relation)]
+    manifest = snapshot.manifest
+    manifest["reachability"] = {}
+
+    for relation in relations:
+        indptr, indices = snapshot.relations[relation]
+        component, members_indptr, members, labels_indptr, labels = closure_labels(len(snapshot), indptr, indices)
+
+        _write_array(os.path.join(path, relation + '.scc'), component)
+        _write_array(os.path.join(path, relation + '.members.indptr'), members_indptr)
+        _write_array(os.path.join(path, relation + '.members'), members)
+        _write_array(os.path.join(path, relation + '.labels.indptr'), labels_indptr)
+        _write_array(os.path.join(path, relation + '.labels'), labels)
+
+        levels, depths, roots_indptr, roots = level_labels(indptr, indices, component, members_indptr, members)
+        _write_array(os.path.join(path, relation + '.levels'), levels)
+        _write_array(os.path.join(path, relation + '.depths'), depths)
+        _write_array(os.path.join(path, relation + '.roots.indptr'), roots_indptr)
+        _write_array(os.path.join(path, relation + '.roots'), roots)
+        manifest["reachability"][relation] = {"components": len(members_indptr) - 1, "intervals": len(labels) // 2,
+                                              "roots": len(roots)}
+
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+
+def _transpose(nodes: int, indptr, indices) -> tuple[array, array]:
+    transposed_indptr = array('Q', bytes(8 * (nodes + 1)))
+    for target in indices:
+        transposed_indptr[target + 1] += 1
+    for i in range(nodes):
+        transposed_indptr[i + 1] += transposed_indptr[i]
+
+    transposed_indices = array('I', bytes(4 * len(indices)))
+    cursor = array('Q', transposed_indptr[:-1])
+    for source in range(nodes):
+        for target in indices[indptr[source]:indptr[source + 1]]:
+            transposed_indices[cursor[target]] = source
+            cursor[target] += 1
+
+    return transposed_indptr, transposed_indices
+
+
+def write_interval_labels(driver, path: str, relations: list[str] = None, batch_size: int = 10000) -> dict:
+    """
+    Writes on every :Synset node the closure labels of the reversed relations of the snapshot in path (see
+    closure_labels): the post-order number of its component and the intervals of the components of its descendants,
+    as a flat list of inclusive lo/hi pairs, sorted and disjoint. They are the merged union of the intervals of its
+    successors and of the successors themselves, so none of them is guaranteed to be a DFS subtree, and the node's own
+    number is only covered if its component is cyclic. A node n descends from c iff n's number falls in one of the
+    intervals of c, and all the nodes descending from c are found by one range seek per interval on the indexed number.
+    The snapshot has to be built from the same dataset.
+    """
+    snapshot = GraphSnapshot(path)
+    relations = [relation for relation in (REACHABILITY_RELATIONS if relations is None else relations)
+                 if snapshot.has_relation(relation) and relation in INTERVAL_LABEL_PROPERTIES]
+    written = {}
+
+    with driver.session() as session:
+        for relation in relations:
+            post, intervals = INTERVAL_LABEL_PROPERTIES[relation]
+            indptr, indices = _transpose(len(snapshot), *snapshot.relations[relation])
+            component, _, _, labels_indptr, labels = closure_labels(len(snapshot), indptr, indices)
+            statement = ("UNWIND $rows AS row MATCH (n:Synset {id: row.id}) SET n." + post + " = row.post, n." +
+                         intervals + " = row.intervals")
+
+            rows = []
+            for i in range(len(snapshot)):
+                label = labels[labels_indptr[component[i]]:labels_indptr[component[i] + 1]]
+                rows.append({"id": snapshot.id_at(i), "post": component[i], "intervals": label.tolist()})
+                if len(rows) == batch_size:
+                    session.run(statement, {"rows": rows}).consume()
+                    rows = []
+            if len(rows) > 0:
+                session.run(statement, {"rows": rows}).consume()
+
+            session.run("CREATE RANGE INDEX synset_" + post + " IF NOT EXISTS FOR (n:Synset) ON (n." + post +
+                        ")").consume()
+            written[relation] = {"nodes": len(snapshot), "intervals": len(labels) // 2}
+
+    return written
+
+
+def load_snapshot(path: str or None) -> GraphSnapshot or None:
+    if path is None or path == "" or not os.path.isfile(os.path.join(path, 'manifest.json')):
+        return None
+
+    try:
+        return GraphSnapshot(path)
+    except (OSError, ValueError) as e:
+        print(f'Unable to load graph snapshot from {path}: {e}')
+        return None
+
+
+if __name__ == "__main__":
+    from neo4j import GraphDatabase
+
+    if len(sys.argv) < 2:
+        print(f'Usage: python {sys.argv[0]} <output_dir> [--all | --reachability | --write-labels | RELATION ...]')
+        sys.exit(1)
+
+    # Only (re)builds the reachability index of an existing snapshot
+    if sys.argv[2:] == ["--reachability"]:
+        print(build_reachability(sys.argv[1]))
+        sys.exit(0)
+
+    selected = sys.argv[2:] if len(sys.argv) > 2 else DEFAULT_RELATIONS
+    graph_driver = GraphDatabase.driver(os.environ["NEO4J_URI"],
+                                        auth=(os.environ["NEO4J_USER"], os.environ["NEO4J_PASSWORD"]))
+    try:
+        if selected == ["--write-labels"]:
+            # Writes the descendant labels of an existing snapshot on the nodes of the database it was built from
+            print(write_interval_labels(graph_driver, sys.argv[1]))
+        else:
+            build_snapshot(graph_driver, sys.argv[1], None if selected == ["--all"] else selected)
+            print(build_reachability(sys.argv[1]))
+    finally:
+        graph_driver.close()
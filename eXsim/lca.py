@@ -0,0 +1,112 @@
+# Least common subsumers over a subgraph fetched once (e.g. the IS_A ancestors of a few seeds).
+# The edge list is indexed by source a single time, so every traversal only visits the out edges of the reached nodes
+# instead of scanning the whole edge set at each step.
+
+
+def adjacency_index(edges) -> dict[str, list[str]]:
+    adjacency = {}
+    for source, target in edges:
+        adjacency.setdefault(source, []).append(target)
+    return adjacency
+
+
+def ancestor_set(adjacency: dict[str, list[str]], term: str) -> set[str]:
+    # Nodes reachable from term through at least one edge (term itself only belongs to it when it lies on a cycle)
+    reached = set()
+    stack = [term]
+
+    while len(stack) > 0:
+        for neighbour in adjacency.get(stack.pop(), ()):
+            if neighbour not in reached:
+                reached.add(neighbour)
+                stack.append(neighbour)
+
+    return reached
+
+
+def strongly_connected_components(nodes, successors) -> dict:
+    """
+    Iterative Tarjan's algorithm, it maps every node reachable from nodes to the number of its component.
+    Components are numbered in reverse topological order: edges between different components always go from a higher
+    number to a lower one.
+    """
+    index = {}
+    low = {}
+    component = {}
+    stack = []
+    counter = 0
+    components = 0
+
+    for root in nodes:
+        if root in index:
+            continue
+
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        work = [(root, iter(successors(root)))]
+
+        while len(work) > 0:
+            node, neighbours = work[-1]
+            descended = False
+
+            for neighbour in neighbours:
+                if neighbour not in index:
+                    index[neighbour] = low[neighbour] = counter
+                    counter += 1
+                    stack.append(neighbour)
+                    work.append((neighbour, iter(successors(neighbour))))
+                    descended = True
+                    break
+                if neighbour not in component:
+                    low[node] = min(low[node], index[neighbour])
+
+            if descended:
+                continue
+
+            work.pop()
+            if len(work) > 0:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+
+            if low[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    component[member] = components
+                    if member == node:
+                        break
+                components += 1
+
+    return component
+
+
+def minimal_subsumers(adjacency: dict[str, list[str]], common: set[str]) -> set[str]:
+    """
+    Common subsumers not dominated by another one: a subsumer is dominated when a common subsumer outside its strongly
+    connected component reaches it. Since the ancestors of a common subsumer are common subsumers too, it is enough
+    to look for an edge coming from a different component of the common subgraph.
+    """
+    component = strongly_connected_components(common, lambda node: adjacency.get(node, ()))
+    dominated = set()
+
+    for node in common:
+        for neighbour in adjacency.get(node, ()):
+            if component[neighbour] != component[node]:
+                dominated.add(component[neighbour])
+
+    return {node for node in common if component[node] not in dominated}
+
+
+def least_common_subsumers(terms: list[str], edges) -> dict:
+    adjacency = adjacency_index(edges)
+    return least_common_subsumers_from_ancestors({term: ancestor_set(adjacency, term) for term in terms}, adjacency)
+
+
+def least_common_subsumers_from_ancestors(constants: dict[str, set[str]], adjacency: dict) -> dict:
+    # Same output, from already known ancestor sets and the adjacency of (at least) the common ones
+    if len(constants) == 0:
+        return {"lca": set(), "constants": constants}
+
+    common = set.intersection(*constants.values())
+
+    return {"lca": minimal_subsumers(adjacency, common), "constants": constants}
@@ -529,8 +529,9 @@ jsonpickle.handlers.registry.register(UnitRelation, JsonEnumHandler)
 
 
 class QueryResult:
-    def __init__(self, results: List[Term]):
+    def __init__(self, results: List[Term], cursor: str or None = None):
         self.results = results
+        self.cursor = cursor
 
     def __eq__(self, other):
         if isinstance(other, QueryResult):
@@ -540,6 +541,24 @@ class QueryResult:
     def __str__(self):
         return ''.join(map(lambda x: str(x) + ", ", self.results))[:-2]
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.cursor is None:
+            del state['cursor']
+        return state
+
+    def __repr__(self):
+        return jsonpickle.encode(self, unpicklable=False)
+
+
+class QueryCount:
+    def __init__(self, count: int, exact: bool = True):
+        self.count = count
+        self.exact = exact
+
+    def __str__(self):
+        return str(self.count) if self.exact else f'~{self.count}'
+
     def __repr__(self):
         return jsonpickle.encode(self, unpicklable=False)
 
@@ -555,6 +574,17 @@ class BooleanAnswer:
         return jsonpickle.encode(self, unpicklable=False)
 
 
+class BooleanAnswers:
+    def __init__(self, answers: list[bool]):
+        self.answers = answers
+
+    def __str__(self):
+        return ''.join(map(lambda x: str(x) + ", ", self.answers))[:-2]
+
+    def __repr__(self):
+        return jsonpickle.encode(self, unpicklable=False)
+
+
 def json_decode(json) -> dict:
     if isinstance(json, str):
         return jsonpickle.decode(json)
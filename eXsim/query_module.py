@@ -1,5 +1,16 @@
+import time
+
 from eXsim.models import *
 from eXsim.babelnet import DatasetManager
+from eXsim.cache import SortedIds
+from eXsim.graph_snapshot import INTERVAL_LABEL_PROPERTIES
+from eXsim.clingo.clingo_for_generic_homomorphism import consistent_hom, execute_clingo_program, inject_facts
+
+PAGE_SIZE = 20
+# Answer cache marker of the answer sets larger than the whole cache
+OVERSIZED_ANSWERS = "oversized"
+# Maximum number of answers of a formula shared by the formulas it contains in a batch (see build_batch_statement)
+BATCH_BASE_LIMIT = 10000
 
 
 def build_match_clauses(query: Formula, params: dict[str, str], exclude_both_constants: bool = True,
@@ -19,7 +30,8 @@ def build_match_clauses(query: Formula, params: dict[str, str], exclude_both_con
             if id_free_var is None:
                 query_str += "MATCH (n:Synset)"
             else:
-                query_str += 'MATCH (n:Synset {id: "' + id_free_var + '"})'
+                params["tid"] = id_free_var
+                query_str += "MATCH (n:Synset {id: $tid})"
         else:
             return None
     else:
@@ -43,7 +55,8 @@ def build_match_clauses(query: Formula, params: dict[str, str], exclude_both_con
                                     if id_free_var is None:
                                         query_components.append("n:Synset")
                                     else:
-                                        query_components.append('n:Synset {id: "' + id_free_var + '"}')
+                                        params["tid"] = id_free_var
+                                        query_components.append("n:Synset {id: $tid}")
                                 else:
                                     query_components.append("n")
 
@@ -90,14 +103,75 @@ def build_match_clauses(query: Formula, params: dict[str, str], exclude_both_con
 
 
 
+def formula_fingerprint(query: Formula) -> tuple or None:
+    # Canonical description of what build_match_clauses_new compiles: the relation and second term of each atom,
+    # with bound variables renamed by order of first occurrence so that only their sharing pattern matters
+    bound_vars = {}
+    atoms = []
+
+    for predicate in query.predicates:
+        if predicate.type == PredicateType.TOP:
+            continue
+        if not isinstance(predicate, Predicate):
+            return None
+
+        term = predicate.terms[1]
+        if term.type == TermType.BOUND_VARIABLE:
+            value = bound_vars.setdefault(",".join(term.name), len(bound_vars))
+        else:
+            value = tuple(term.name)
+        atoms.append((predicate.name, term.type.value, value))
+
+    return tuple(atoms)
+
+
 def build_match_clauses_new(query: Formula, params: dict[str, str],
-                        is_first_free_var: bool = True, id_free_var: str = None):
-    
-    constants_detected = len(params)
-    free_var = "(n" + (":Synset" if is_first_free_var else "") + ")"
-    last_bound = 0
+                        is_first_free_var: bool = True, id_free_var: str = None, cursor: str = None,
+                        id_free_vars: list[str] = None):
+    # The compiled text only depends on the fingerprint of the formula, on the number of parameters already bound
+    # (they are numbered from there) and on which optional clauses are present, so it is compiled once per key,
+    # in-ranks lookup included. Term ids and cursor values are the only parameters bound on every call.
+    fingerprint = formula_fingerprint(query)
+    if fingerprint is None:
+        return compile_match_clauses(query, params, is_first_free_var, id_free_var, cursor, id_free_vars)
+
+    plan_cache = DatasetManager().query_plan_cache
+    key = (fingerprint, len(params), is_first_free_var, id_free_var is not None, cursor is not None,
+           id_free_vars is not None)
+    plan = plan_cache.get(key)
+
+    if plan is None:
+        compiled_params = dict(params)
+        query_str = compile_match_clauses(query, compiled_params, is_first_free_var, id_free_var, cursor,
+                                          id_free_vars)
+        if query_str is None:
+            return None
+
+        binding = tuple((name, value) for name, value in compiled_params.items()
+                        if name not in params and name not in ["tid", "tids", "cursor"])
+        plan = (query_str, binding)
+        plan_cache.put(key, plan)
+
+    params.update(plan[1])
+    if id_free_var is not None:
+        params["tid"] = id_free_var
+    if id_free_vars is not None:
+        params["tids"] = id_free_vars
+    if cursor is not None:
+        params["cursor"] = cursor
+
+    return plan[0]
 
 
+def relation_cost(relation: str) -> int:
+    # Number of edges of a relation, one missing from the ranking is assumed to be as large as the largest one
+    relations_ranking = DatasetManager().relations_ranking
+    return relations_ranking.get(relation, max(relations_ranking.values(), default=0))
+
+
+def classify_atoms(query: Formula) -> dict or None:
+    # Groups the evaluated atoms by the second term: constants of IS_A/PART_OF (checked transitively), other
+    # constants, bound variables occurring once (only checked) and bound variables shared by several atoms (joins)
     query_terms = {"constants": {}, "only_check_bound_vars": {}, "join_bound_vars": {}, "deriv_constants": {}}
 
     for predicate in query.predicates:
@@ -129,105 +203,145 @@ def build_match_clauses_new(query: Formula, params: dict[str, str],
                             else:
                                 query_terms["join_bound_vars"][name].append(predicate.name)
 
+    return query_terms
+
+
+def deriv_constant_ranks(query_terms: dict) -> list[tuple[str, int, str]]:
+    # A derived constant missing from the dataset has no descendants: as anchor it immediately yields no answers
+    deriv_rankings = {rank_tuple[0]: rank_tuple for rank_tuple in
+                      DatasetManager().get_in_rank_by_id_batched(list(query_terms["deriv_constants"]))}
+
+    sorted_deriv_constants = []
+    for term_name in query_terms["deriv_constants"]:
+        rank_tuple = deriv_rankings.get(term_name, (term_name, 0, 0))
+        for predicate_name in query_terms["deriv_constants"][term_name]:
+            if predicate_name == "IS_A":
+                rank = rank_tuple[1]
+            else:
+                rank = rank_tuple[2]
+
+            if rank is None:
+                rank = relation_cost(predicate_name)
+            sorted_deriv_constants.append((predicate_name, rank, term_name))
+
+    return sorted_deriv_constants
+
+
+def compile_match_clauses(query: Formula, params: dict[str, str],
+                          is_first_free_var: bool = True, id_free_var: str = None, cursor: str = None,
+                          id_free_vars: list[str] = None):
+    
+    constants_detected = len(params)
+    free_var = "(n" + (":Synset" if is_first_free_var else "") + ")"
+    last_bound = 0
+
+
+    query_terms = classify_atoms(query)
+    if query_terms is None:
+        return None
+
     only_to_check_predicates = []
     for name in query_terms["only_check_bound_vars"]:
         only_to_check_predicates.append(query_terms["only_check_bound_vars"][name])
 
 
+    dataset_manager = DatasetManager()
     selected_term = None
+    anchor_conditions = []
+    anchored_join = None
+    distinct_anchor = False
     constant_clauses = ""
     join_bound_vars_clauses = ""
     only_to_check_predicates_clauses = ""
     deriv_constants_clauses = ""
-    sorted_deriv_constants = []
-
-    if id_free_var is not None:
-        params["tid"] = id_free_var
-        selected_term = "MATCH (n:Synset {id: $tid})"
-        dataset_manager = DatasetManager()
-        deriv_rankings = dataset_manager.get_in_rank_by_id_batched(list(query_terms["deriv_constants"]))
-
-        for rank_tuple in deriv_rankings:
-            for predicate_name in query_terms["deriv_constants"][rank_tuple[0]]:
-                if predicate_name == "IS_A":
-                    rank = rank_tuple[1]
-                else:
-                    rank = rank_tuple[2]
-                
-                sorted_deriv_constants.append((predicate_name, rank, rank_tuple[0]))
-
-    
-    if selected_term is None:
-        dataset_manager = DatasetManager()
-        
-        is_predicate = False
-        minRank = None
-
-        deriv_rankings = dataset_manager.get_in_rank_by_id_batched(list(query_terms["deriv_constants"]))
+    sorted_deriv_constants = deriv_constant_ranks(query_terms)
 
-        for rank_tuple in deriv_rankings:
-            for predicate_name in query_terms["deriv_constants"][rank_tuple[0]]:
-                if predicate_name == "IS_A":
-                    rank = rank_tuple[1]
-                else:
-                    rank = rank_tuple[2]
-                
-                sorted_deriv_constants.append((predicate_name, rank, rank_tuple[0]))
-
-                if minRank is None or minRank[1] > rank:
-                    minRank = (predicate_name, rank, rank_tuple[0])
+    constant_pairs = [[term_name, predicate_name] for term_name in query_terms["constants"]
+                      for predicate_name in query_terms["constants"][term_name]]
 
-        if minRank is None or minRank[1] > 1000000:
-            if len(query_terms["constants"]) == 0 and len(query_terms["join_bound_vars"]) == 0:
-                for predicate_name in only_to_check_predicates:
-                    rank = dataset_manager.relations_ranking[predicate_name]
+    if id_free_var is not None or id_free_vars is not None:
+        if id_free_var is not None:
+            params["tid"] = id_free_var
+            selected_term = "MATCH (n:Synset {id: $tid})"
+        else:
+            params["tids"] = id_free_vars
+            selected_term = "MATCH (n:Synset) WHERE n.id IN $tids"
 
-                    if minRank is None or minRank[1] > rank:
-                        minRank = (predicate_name, rank)
-                        is_predicate = True
+        constant_costs = {(pair[0], pair[1]): relation_cost(pair[1]) for pair in constant_pairs}
+    else:
+        constant_costs = dataset_manager.get_in_degree_batched(constant_pairs) if len(constant_pairs) > 0 else {}
+
+        # Cost based anchor: the clause expected to bind n to the fewest synsets, that is the in-rank of a derived
+        # constant, the in-degree of a constant for its relation or the size of a relation that just has to occur
+        candidates = [(deriv_const[1], "deriv", deriv_const) for deriv_const in sorted_deriv_constants]
+        candidates += [(constant_costs[key], "constant", key) for key in sorted(constant_costs)]
+        candidates += [(min(map(relation_cost, predicates)), "join", term_name)
+                       for term_name, predicates in query_terms["join_bound_vars"].items()]
+        candidates += [(relation_cost(predicate_name), "check", predicate_name)
+                       for predicate_name in only_to_check_predicates]
+        anchor = min(candidates, key=lambda candidate: candidate[0], default=None)
+
+        if anchor is None:
+            selected_term = "MATCH " + free_var
+        elif anchor[1] == "deriv":
+            term_node = ("c" + str(constants_detected))
+            params[term_node] = anchor[2][2]
+            constants_detected += 1
+            if anchor[2][0] in dataset_manager.interval_labels:
+                # Descendants of the constant are found by range seeks, one for each interval of its label
+                post, intervals = INTERVAL_LABEL_PROPERTIES[anchor[2][0]]
+                label_node = "l" + term_node
+                interval = "i" + term_node
+                selected_term = ("MATCH (" + label_node + ":Synset {id:$" + term_node + "}) UNWIND range(0, size(" +
+                                 label_node + "." + intervals + ") - 1, 2) AS " + interval + " MATCH " + free_var)
+                anchor_conditions.append("n." + post + " >= " + label_node + "." + intervals + "[" + interval + "]")
+                anchor_conditions.append("n." + post + " <= " + label_node + "." + intervals + "[" + interval + " + 1]")
             else:
-                minRank = None
-        
-        if minRank is not None:
-            if is_predicate:
-                if minRank[0] == "IS_A" or minRank[0] == "PART_OF":
-                    pred_name = f"`{minRank[0]}`*"
-                else:
-                    pred_name = f"`{minRank[0]}`"
-                selected_term = "MATCH " + free_var + "-[:" + pred_name + "]->(:Synset)"
-                only_to_check_predicates.remove(minRank[0])
+                selected_term = "MATCH " + free_var + "-[:`" + anchor[2][0] + "`*]->(:Synset {id:$" + term_node + "})"
+            anchor_conditions.append("n.id <> $" + term_node)
+            distinct_anchor = True
+            sorted_deriv_constants.remove(anchor[2])
+        elif anchor[1] == "join":
+            anchored_join = anchor[2]
+        elif anchor[1] == "check":
+            if anchor[2] == "IS_A" or anchor[2] == "PART_OF":
+                pred_name = f"`{anchor[2]}`*"
             else:
-                pred_name = f"`{minRank[0]}`*"
-                term_node = ("c" + str(constants_detected))
-                params[term_node] = minRank[2]
-                constants_detected += 1
-                selected_term = "MATCH " + free_var + "-[:" + pred_name + "]->(:Synset {id:$" + term_node + "}) WITH DISTINCT n"
-                query_terms["deriv_constants"][minRank[2]].remove(minRank[0])
-                if len(query_terms["deriv_constants"][minRank[2]]) == 0:
-                    del query_terms["deriv_constants"][minRank[2]]
-
-    for term_name in query_terms["constants"]:
-        params["c" + str(constants_detected)] = term_name
-        term_node = ":Synset {id:$c" + str(constants_detected) + "}"
-        constants_detected += 1
+                pred_name = f"`{anchor[2]}`"
+            selected_term = "MATCH " + free_var + "-[:" + pred_name + "]->(:Synset)"
+            only_to_check_predicates.remove(anchor[2])
+
+    # Filters follow in increasing order of estimated matches, so the most selective ones discard rows first.
+    # A constant anchor is the cheapest constant, so it is the first one emitted while selected_term is unset.
+    term_nodes = {}
+    for key in sorted(constant_costs, key=lambda pair: (constant_costs[pair], pair)):
+        term_name, predicate_name = key
+        if term_name not in term_nodes:
+            term_nodes[term_name] = "c" + str(constants_detected)
+            params[term_nodes[term_name]] = term_name
+            constants_detected += 1
+        term_node = ":Synset {id:$" + term_nodes[term_name] + "}"
+
+        if predicate_name == "IS_A" or predicate_name == "PART_OF":
+            pred_name = f"`{predicate_name}`*"
+        else:
+            pred_name = f"`{predicate_name}`"
 
-        for predicate_name in query_terms["constants"][term_name]:
-            if predicate_name == "IS_A" or predicate_name == "PART_OF":
-                pred_name = f"`{predicate_name}`*"
-            else:
-                pred_name = f"`{predicate_name}`"
+        if selected_term is None and anchored_join is None:
+            selected_term = "MATCH " + free_var + "-[:" + pred_name + "]->(" + term_node + ")"
+        else:
+            constant_clauses += " MATCH (n)" + "-[:" + pred_name + "]->(" + term_node + ")"
 
-            if selected_term is None:
-                selected_term = "MATCH " + free_var + "-[:" + pred_name + "]->(" + term_node + ")"
-            else:
-                constant_clauses += " MATCH (n)" + "-[:" + pred_name + "]->(" + term_node + ")"
+    join_terms = sorted(query_terms["join_bound_vars"],
+                        key=lambda name: (name != anchored_join,
+                                          min(map(relation_cost, query_terms["join_bound_vars"][name]))))
 
-    for term_name in query_terms["join_bound_vars"]:
+    for term_name in join_terms:
         bound_var_map = "y" + str(last_bound)
         last_bound += 1
         first = True
 
-        for predicate_name in query_terms["join_bound_vars"][term_name]:
+        for predicate_name in sorted(query_terms["join_bound_vars"][term_name], key=relation_cost):
             if predicate_name == "IS_A" or predicate_name == "PART_OF":
                 pred_name = f"`{predicate_name}`*"
             else:
@@ -241,9 +355,22 @@ def build_match_clauses_new(query: Formula, params: dict[str, str],
             first = False
 
 
+    # Keyset pagination: the anchor only produces ids following the last one returned by the previous page
+    if cursor is not None:
+        params["cursor"] = cursor
+        anchor_conditions.append("n.id > $cursor")
+
+    if len(anchor_conditions) > 0:
+        selected_term += " WHERE " + " AND ".join(anchor_conditions)
+
+    if distinct_anchor:
+        selected_term += " WITH DISTINCT n"
+
     if len(only_to_check_predicates) > 0:
-        predicates_string = "|".join(list(map(lambda pred: f"{pred}>", only_to_check_predicates)))
-        only_to_check_predicates_clauses += ' WITH DISTINCT n, apoc.node.relationships.exist(n, "' + predicates_string + '") as map WHERE all(x in [k IN KEYS(map) | map[k]] where x)'
+        predicates_node = "c" + str(constants_detected)
+        params[predicates_node] = "|".join(list(map(lambda pred: f"{pred}>", only_to_check_predicates)))
+        constants_detected += 1
+        only_to_check_predicates_clauses += " WITH DISTINCT n, apoc.node.relationships.exist(n, $" + predicates_node + ") as map WHERE all(x in [k IN KEYS(map) | map[k]] where x)"
 
     sorted_deriv_constants.sort(key=lambda r: r[1])
 
@@ -263,6 +390,15 @@ def build_match_clauses_new(query: Formula, params: dict[str, str],
         term_node = ("c" + str(constants_detected))
         params[term_node] = term_name
         constants_detected += 1
+
+        if predicate_name in dataset_manager.interval_labels:
+            post, intervals = INTERVAL_LABEL_PROPERTIES[predicate_name]
+            label = "l" + term_node + "." + intervals
+            deriv_constants_clauses += (" WITH n MATCH (l" + term_node + ":Synset {id:$" + term_node + "})" +
+                                        " WHERE n.id <> $" + term_node + " AND any(i IN range(0, size(" + label +
+                                        ") - 1, 2) WHERE " + label + "[i] <= n." + post + " <= " + label + "[i + 1])")
+            continue
+
         found_deriv += 1
 
         if found_deriv <= 10:
@@ -294,61 +430,470 @@ def build_match_clauses_new(query: Formula, params: dict[str, str],
 
 
 
-def execute_query(query: Formula, exclude_both_constants: bool, page: int = 0):
-    params = {}
-    query_str = build_match_clauses_new(query, params)
+def ordered_pages(cursor: str = None) -> bool:
+    # Sorting by id makes the server evaluate and sort every answer before returning a page, so it is only done when
+    # pages have to agree with a cursor (an empty one starts from the first page) or with the answers materialised in
+    # id order by the answer cache. Otherwise offset pages stream the first answers found, without a cursor.
+    return cursor is not None or DatasetManager().answer_cache.max_bytes > 0
 
-    if query_str is None:
-        return []
+
+def paginate(query_str: str, params: dict, page: int, cursor: str = None):
+    # Page bounds are parameters, so that every page of a query reuses the same statement (and execution plan)
+    params["limit"] = PAGE_SIZE
+
+    if cursor is not None:
+        return query_str + " WITH DISTINCT n.id as id RETURN id ORDER BY id LIMIT $limit"
 
     if page < 0:
         page = 0
-    
-    skip = page * 20
 
-    query_str += f" WITH DISTINCT n.id as id RETURN id SKIP {skip} LIMIT 20"
-    return QueryResult(DatasetManager().get_synsets_by_cq(query_str, params))
+    params["skip"] = page * PAGE_SIZE
+    order = " ORDER BY id" if ordered_pages() else ""
+
+    return query_str + " WITH DISTINCT n.id as id RETURN id" + order + " SKIP $skip LIMIT $limit"
+
+
+def profile_query(query: Formula, page: int = 0, cursor: str = None, explain: bool = False) -> dict or None:
+    # Compiles and runs a page of query under PROFILE (or only plans it under EXPLAIN), reporting the statement, its
+    # parameters, the operators of the plan and how time splits between compilation and the database
+    dataset_manager = DatasetManager()
+    params = {}
+
+    started = time.perf_counter()
+    query_str = build_match_clauses_new(query, params, cursor=cursor)
+    compiled = time.perf_counter()
+
+    if query_str is None:
+        return None
+
+    statement = paginate(query_str, params, page, cursor)
+    profile = dataset_manager.get_profile_by_cq(("EXPLAIN " if explain else "PROFILE ") + statement, params)
+    executed = time.perf_counter()
+
+    profile.update({"statement": statement, "params": params, "compile_ms": (compiled - started) * 1000,
+                    "database_ms": (executed - compiled) * 1000,
+                    "db_hits": sum(operator["db_hits"] or 0 for operator in profile["operators"]),
+                    "plan_cache": dataset_manager.query_plan_cache.stats()})
+    return profile
+
+
+def exists_statement(query_str: str):
+    # No ordering nor deduplication, evaluation stops as soon as the first answer is found
+    return query_str + " RETURN n.id as id LIMIT 1"
+
+
+def page_result(results: list[Term], ordered: bool = True):
+    # A full page of ordered results may be followed by others, its last id is the cursor to resume from
+    next_cursor = results[-1].name[0] if ordered and len(results) == PAGE_SIZE else None
+    return QueryResult(results, next_cursor)
+
+
+def cached_answers(key: tuple, build=None) -> tuple[SortedIds, bool] or None:
+    # When the answer cache is enabled the first request of a query materialises its sorted distinct answers (up to
+    # answer_cache_limit of them), flagged as complete if no answer was left out; build returns (query, params),
+    # without it only answers already materialised are returned. Answers too large for the cache are remembered as
+    # such, so that they are not materialised again on every request.
+    dataset_manager = DatasetManager()
+    if dataset_manager.answer_cache.max_bytes <= 0 or None in key:
+        return None
+
+    key = key + (dataset_manager.dataset_version,)
+    answers = dataset_manager.answer_cache.get(key)
+
+    if answers is None and build is not None:
+        statement = build()
+        if statement is None:
+            return None
+
+        query_str, params = statement
+        query_str += " WITH DISTINCT n.id as id RETURN id ORDER BY id"
+        limit = dataset_manager.answer_cache_limit
+        if limit > 0:
+            params["limit"] = limit
+            query_str += " LIMIT $limit"
+
+        ids = dataset_manager.get_ids_by_cq(query_str, params)
+        answers = (ids, limit <= 0 or len(ids) < limit)
+        if not dataset_manager.answer_cache.put(key, answers):
+            dataset_manager.answer_cache.put(key, OVERSIZED_ANSWERS)
+
+    return None if answers is OVERSIZED_ANSWERS else answers
+
+
+def query_answers(query: Formula, materialise: bool = True) -> tuple[SortedIds, bool] or None:
+    def build():
+        params = {}
+        query_str = build_match_clauses_new(query, params)
+        return None if query_str is None else (query_str, params)
+
+    return cached_answers(("query", formula_fingerprint(query)), build if materialise else None)
+
+
+def diff_answers(query1: Formula, query2: Formula, materialise: bool = True) -> tuple[SortedIds, bool] or None:
+    def build():
+        params = {}
+        query_str = build_diff_clauses(query1, query2, params)
+        return None if query_str is None else (query_str, params)
+
+    return cached_answers(("diff", formula_fingerprint(query1), formula_fingerprint(query2)),
+                          build if materialise else None)
+
+
+def answers_page(answers: tuple[SortedIds, bool] or None, page: int, cursor: str = None) -> list[Term] or None:
+    # None when the page is not fully covered by the materialised answers
+    if answers is None:
+        return None
+
+    ids, complete = answers
+    start = ids.index_after(cursor) if cursor is not None else max(page, 0) * PAGE_SIZE
+
+    if start + PAGE_SIZE > len(ids) and not complete:
+        return None
+
+    return list(map(Term, ids[start:start + PAGE_SIZE]))
+
+
+def execute_query(query: Formula, exclude_both_constants: bool, page: int = 0, cursor: str = None):
+    results = answers_page(query_answers(query), page, cursor)
+    if results is not None:
+        return page_result(results)
+
+    params = {}
+    query_str = build_match_clauses_new(query, params, cursor=cursor)
+
+    if query_str is None:
+        return []
+
+    return page_result(DatasetManager().get_synsets_by_cq(paginate(query_str, params, page, cursor), params),
+                       ordered_pages(cursor))
    
 
+def estimate_count(query_terms: dict) -> int:
+    # Conjuncts are assumed to be independent, each keeping the share of synsets it is estimated to bind (see the
+    # anchor costs of compile_match_clauses), and the estimate never exceeds the most selective one
+    dataset_manager = DatasetManager()
+    total = dataset_manager.get_synset_count()
+
+    costs = [deriv_const[1] for deriv_const in deriv_constant_ranks(query_terms)]
+    constant_pairs = [[term_name, predicate_name] for term_name in query_terms["constants"]
+                      for predicate_name in query_terms["constants"][term_name]]
+    if len(constant_pairs) > 0:
+        costs += list(dataset_manager.get_in_degree_batched(constant_pairs).values())
+    costs += [min(map(relation_cost, predicates)) for predicates in query_terms["join_bound_vars"].values()]
+    costs += [relation_cost(predicate_name) for predicate_name in query_terms["only_check_bound_vars"].values()]
+
+    if len(costs) == 0 or total == 0:
+        return total
+
+    estimate = float(total)
+    for cost in costs:
+        estimate *= min(cost, total) / total
+
+    return int(round(min(estimate, min(costs))))
+
+
+def count_query(query: Formula, timeout: float = None) -> QueryCount or None:
+    # Exact count of the distinct answers if it can be computed within timeout seconds, an estimate otherwise
+    dataset_manager = DatasetManager()
+
+    answers = query_answers(query, materialise=False)
+    if answers is not None and answers[1]:
+        return QueryCount(len(answers[0]))
+
+    params = {}
+    query_str = build_match_clauses_new(query, params)
+
+    if query_str is None:
+        return None
+
+    count = dataset_manager.get_count_by_cq(query_str + " RETURN count(DISTINCT n) as count", params,
+                                            timeout if timeout is not None else dataset_manager.count_timeout)
+    if count is not None:
+        return QueryCount(count)
+
+    return QueryCount(estimate_count(classify_atoms(query)), False)
+
+
+def check_deriv_atoms(terms: list[str], query: Formula) -> tuple[list[str], Formula] or None:
+    # IS_A/PART_OF atoms towards constants are ancestor tests, answered in-process when the graph snapshot has the
+    # reachability index of their relations. Returns the terms passing all of them and the formula of the other atoms
+    dataset_manager = DatasetManager()
+    deriv_atoms = []
+    other_atoms = []
+
+    for predicate in query.predicates:
+        if (isinstance(predicate, Predicate) and predicate.type != PredicateType.TOP
+                and (predicate.name == "IS_A" or predicate.name == "PART_OF")
+                and dataset_manager.available_relations.get(predicate.name, False)
+                and predicate.terms[1].type in [TermType.CONSTANT, TermType.AGGREGATED_TERM]):
+            deriv_atoms += [(predicate.name, name) for name in predicate.terms[1].name]
+        else:
+            other_atoms.append(predicate)
+
+    if len(deriv_atoms) == 0:
+        return None
+
+    if any(dataset_manager.reachability_index(relation) is None for relation, _ in deriv_atoms):
+        return None
+
+    graph_snapshot = dataset_manager.graph_snapshot
+    passing = [term for term in terms if all(term != ancestor and graph_snapshot.reaches(relation, term, ancestor)
+                                             for relation, ancestor in deriv_atoms)]
+
+    return passing, Formula(other_atoms)
+
+
 def is_term_in_output(term: Term, query: Formula):
+    # Only answers already materialised by page requests are used, a cold check stops at its first witness instead
+    answers = query_answers(query, materialise=False)
+    if answers is not None:
+        ids, complete = answers
+        if term.name[0] in ids:
+            return True
+        # Answers are materialised in id order, so a partial set also settles every id up to its last one
+        if complete or (len(ids) > 0 and term.name[0] < ids[-1]):
+            return False
+
+    checked = check_deriv_atoms([term.name[0]], query)
+    if checked is not None:
+        if len(checked[0]) == 0:
+            return False
+        query = checked[1]
+
     params = {}
     query_str = build_match_clauses_new(query, params, id_free_var=term.name[0])
 
     if query_str is None:
         return False
 
-    query_str += " WITH DISTINCT n.id as id RETURN id"
-    
-    if len(DatasetManager().get_synsets_by_cq(query_str, params)) > 0:
-        return True
-    
-    return False
+    return DatasetManager().has_answers_by_cq(exists_statement(query_str), params)
 
 
-def is_subset(query1: Formula, query2: Formula):
-    diff = compute_diff_output(query1, query2, 0)
+def evaluated_atoms(query: Formula) -> Formula or None:
+    # The atoms build_match_clauses_new actually evaluates: TOP and unavailable relations are ignored, aggregated
+    # terms stand for one atom per constant and the first term is always the free variable
+    free_var = Term("X", TermType.FREE_VARIABLE)
+    available_relations = DatasetManager().available_relations
+    atoms = {}
+
+    for predicate in query.predicates:
+        if predicate.type == PredicateType.TOP or not available_relations.get(predicate.name, False):
+            continue
+        if not isinstance(predicate, Predicate):
+            return None
+
+        term = predicate.terms[1]
+        if term.type == TermType.CONSTANT or term.type == TermType.AGGREGATED_TERM:
+            terms = [Term(name) for name in term.name]
+        elif term.type == TermType.BOUND_VARIABLE:
+            terms = [Term(",".join(term.name), TermType.BOUND_VARIABLE)]
+        else:
+            continue
+
+        for term in terms:
+            atoms[(predicate.name, term.type, term.name[0])] = Predicate(predicate.type, predicate.name,
+                                                                         (free_var, term))
+
+    return Formula(list(atoms.values()))
+
+
+def is_contained(query1: Formula, query2: Formula) -> bool:
+    # Conjunctive query containment: query1 is contained in query2 if query2 maps homomorphically into query1 with
+    # the free variable fixed. False only means that containment could not be proved without looking at the data.
+    atoms1 = evaluated_atoms(query1)
+    atoms2 = evaluated_atoms(query2)
+
+    if atoms1 is None or atoms2 is None:
+        return False
+
+    program = ['']
+    add_info = [False, False, False]
+
+    if not inject_facts(atoms2, atoms1, program, add_info):
+        return False
+
+    return execute_clingo_program(program[0] + consistent_hom(add_info), quiet=True)
+
+
+def are_terms_in_output(terms: list[str], query: Formula) -> list[bool]:
+    # Membership of many terms with a single evaluation, anchored on the given ids
+    found = set()
+    unknown = list(dict.fromkeys(terms))
+
+    answers = query_answers(query, materialise=False)
+    if answers is not None:
+        ids, complete = answers
+        found = set(filter(lambda term: term in ids, unknown))
+        if not complete:
+            unknown = [term for term in unknown if term not in found and (len(ids) == 0 or term > ids[-1])]
+        else:
+            unknown = []
+
+    checked = check_deriv_atoms(unknown, query) if len(unknown) > 0 else None
+    if checked is not None:
+        unknown, query = checked
+
+    if len(unknown) > 0:
+        params = {}
+        query_str = build_match_clauses_new(query, params, id_free_vars=unknown)
+
+        if query_str is not None:
+            found.update(DatasetManager().get_ids_by_cq(query_str + " RETURN DISTINCT n.id as id", params))
 
-    if len(diff.results) == 0:
+    return [term in found for term in terms]
+
+
+def is_subset(query1: Formula, query2: Formula):
+    if is_contained(query1, query2):
         return True
-    
-    return False
 
+    # An already materialised difference settles the check, but it is not worth materialising one just for it
+    answers = diff_answers(query1, query2, materialise=False)
+    if answers is not None:
+        return len(answers[0]) == 0
 
-def compute_diff_output(query1: Formula, query2: Formula, page: int = 0):
     params = {}
-    query1_str = build_match_clauses_new(query1, params)
+    query_str = build_diff_clauses(query1, query2, params)
+
+    if query_str is None:
+        return False
+
+    return not DatasetManager().has_answers_by_cq(exists_statement(query_str), params)
+
+
+def build_diff_clauses(query1: Formula, query2: Formula, params: dict, cursor: str = None):
+    query1_str = build_match_clauses_new(query1, params, cursor=cursor)
     query2_str = build_match_clauses_new(query2, params, is_first_free_var=False)
 
     if query1_str is None or query2_str is None:
+        return None
+
+    return query1_str + " WITH DISTINCT n WHERE NOT EXISTS {" + query2_str + "}"
+
+
+def compute_diff_output(query1: Formula, query2: Formula, page: int = 0, cursor: str = None):
+    results = answers_page(diff_answers(query1, query2), page, cursor)
+    if results is not None:
+        return page_result(results)
+
+    params = {}
+    query_str = build_diff_clauses(query1, query2, params, cursor)
+
+    if query_str is None:
         return []
 
-    query_str = query1_str + " WITH DISTINCT n WHERE NOT EXISTS {" + query2_str + "}"
+    return page_result(DatasetManager().get_synsets_by_cq(paginate(query_str, params, page, cursor), params),
+                       ordered_pages(cursor))
 
-    if page < 0:
-        page = 0
-    
-    skip = page * 20
 
-    query_str += f" WITH DISTINCT n.id as id RETURN id SKIP {skip} LIMIT 20"
+def constant_atom_key(predicate: Predicate) -> tuple or None:
+    if predicate.terms[0].type != TermType.FREE_VARIABLE or predicate.terms[1].type != TermType.CONSTANT:
+        return None
+    return predicate.name, predicate.terms[1].name[0], predicate.is_deriv
+
 
-    return QueryResult(DatasetManager().get_synsets_by_cq(query_str, params))
\ No newline at end of file
+def build_batch_statement(atoms: dict[int, Formula], order: list[int], general: dict[int, int], params: dict):
+    # A single statement evaluating a page of each formula. A formula containing others (see is_contained) is
+    # matched once into a base of at most BATCH_BASE_LIMIT nodes, streamed without sorting: when it is complete, the
+    # page of that formula and of every formula it contains is filtered from the bound n of the base instead of being
+    # matched again from its own anchor, which is only done (for all of them) when the base exceeds the limit.
+    # Subqueries run in order and a formula contained in one with an empty page is skipped.
+    page = (" WITH DISTINCT n.id as id" + (" ORDER BY id" if ordered_pages() else "") +
+            " SKIP $skip LIMIT $limit RETURN collect(id) as ")
+    roots = {}
+    statement = ""
+
+    for i in order:
+        roots[i] = roots[general[i]] if i in general else i
+    shared = {roots[i] for i in general}
+    if len(shared) > 0:
+        params["base_size"] = BATCH_BASE_LIMIT + 1
+
+    for i in order:
+        if len(atoms[i].predicates) > 0:
+            match = build_match_clauses_new(atoms[i], params)
+        else:
+            match = "MATCH (n:Synset)"
+
+        if roots[i] not in shared:
+            statement += " CALL { " + match + page + "r" + str(i) + " }"
+            continue
+
+        base = "b" + str(roots[i])
+        if roots[i] == i:
+            statement += " CALL { " + match + " WITH DISTINCT n LIMIT $base_size RETURN collect(n) as " + base + " }"
+
+        imported = [base]
+        conditions = []
+        if i in general:
+            imported.append("r" + str(general[i]))
+            conditions.append("size(r" + str(general[i]) + ") > 0")
+
+        check = ""
+        if roots[i] != i:
+            # Atoms linking the free variable to a constant as in the base formula hold on every node of the base
+            satisfied = set(filter(None, map(constant_atom_key, atoms[roots[i]].predicates)))
+            residual = Formula([predicate for predicate in atoms[i].predicates
+                                if constant_atom_key(predicate) not in satisfied])
+            if len(residual.predicates) > 0:
+                check = " " + build_match_clauses_new(residual, params, is_first_free_var=False)
+
+        head = "WITH " + ", ".join(imported) + " WITH " + ", ".join(imported) + " WHERE "
+        statement += (" CALL { " + head + " AND ".join(conditions + ["size(" + base + ") < $base_size"]) +
+                      " UNWIND " + base + " AS n" + check + page + "a" + str(i) + " }")
+        statement += (" CALL { " + head + " AND ".join(conditions + ["size(" + base + ") >= $base_size"]) + " " +
+                      match + page + "o" + str(i) + " }")
+        statement += " WITH *, a" + str(i) + " + o" + str(i) + " as r" + str(i)
+
+    return statement.strip() + " RETURN " + ", ".join(map(lambda i: "r" + str(i), order))
+
+
+def execute_queries(queries: list[Formula], page: int = 0) -> list[QueryResult]:
+    # Evaluates a page of several related formulas (e.g. the levels of an expansion) within one statement.
+    # Equivalent formulas are evaluated once and a formula statically contained in another one (see is_contained)
+    # is only evaluated if the more general one has answers, by filtering the answers of the most general one when
+    # they are few enough (see build_batch_statement).
+    formulas = {}
+    positions = []
+
+    for query in queries:
+        fingerprint = formula_fingerprint(query)
+        if fingerprint is not None and fingerprint not in formulas:
+            formulas[fingerprint] = query
+        positions.append(fingerprint)
+
+    fingerprints = list(formulas)
+    atoms = {i: evaluated_atoms(formulas[fingerprint]) for i, fingerprint in enumerate(fingerprints)}
+    # Formulas with fewer atoms, and then fewer constants, first: they are the candidate more general ones
+    order = sorted(atoms, key=lambda i: (len(atoms[i].predicates), len(list(filter(
+        lambda predicate: predicate.terms[1].type == TermType.CONSTANT, atoms[i].predicates)))))
+    general = {}
+
+    for position, i in enumerate(order):
+        for j in reversed(order[:position]):
+            if is_contained(formulas[fingerprints[i]], formulas[fingerprints[j]]):
+                general[i] = j
+                break
+
+    pages = {}
+    for i in order:
+        results = answers_page(query_answers(formulas[fingerprints[i]], materialise=False), page)
+        if results is None and i in general and general[i] in pages and len(pages[general[i]]) == 0:
+            results = []
+        if results is not None:
+            pages[i] = results
+
+    pending = [i for i in order if i not in pages]
+    if len(pending) > 0:
+        params = {"skip": max(page, 0) * PAGE_SIZE, "limit": PAGE_SIZE}
+        statement = build_batch_statement({i: atoms[i] for i in pending}, pending,
+                                          {i: j for i, j in general.items() if i in pending and j in pending},
+                                          params)
+        columns = list(map(lambda i: "r" + str(i), pending))
+
+        for i, ids in zip(pending, DatasetManager().get_id_lists_by_cq(statement, params, columns)):
+            pages[i] = list(map(Term, ids))
+
+    index = {fingerprint: i for i, fingerprint in enumerate(fingerprints)}
+    return [page_result(pages[index[fingerprint]], ordered_pages()) if fingerprint is not None else QueryResult([])
+            for fingerprint in positions]
@@ -14,6 +14,8 @@ from eXsim.expansion import expand, relax_transitive, relax_transitive_v2
 from eXsim.models import *
 
 from eXsim.babelnet import DatasetManager
+from eXsim.babelnet_async import AsyncDatasetManager
+from eXsim.statements import statement_stats
 import eXsim.summary_module as sm
 import eXsim.query_module as qm
 
@@ -21,6 +23,12 @@ api = Api(app, doc='/api/docs', title='eXsim API', version='0.1', description='e
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')
 jwt = JWTManager(app)
 
+
+@app.teardown_request
+def close_unit_of_work(exception=None):
+    DatasetManager().close_unit_of_work()
+
+
 babelnet_entity_model = api.model('BabelNetEntity', {
     'main_sense': fields.String(required=True, description='Main Sense'),
     'description': fields.String(required=False, description='A brief description of the entity'),
@@ -113,17 +121,56 @@ query_model = api.model('Query', {
     'query': fields.Nested(formula_model, required=True, description='Query to evaluate'),
     'exclude_both_constants': fields.Boolean(required=False,
                                              description='Exclude from evaluation atoms with both terms constant'),
-    'page': fields.Integer(required=False, description='Page of results')
+    'page': fields.Integer(required=False, description='Page of results'),
+    'cursor': fields.String(required=False,
+                            description='Cursor of the previous page (empty for the first one), '
+                                        'it takes precedence over page')
 })
 
 query_results_model = api.model('QueryResults', {
-    'results': fields.List(fields.Nested(term_model), required=True, description='List of results')
+    'results': fields.List(fields.Nested(term_model), required=True, description='List of results'),
+    'cursor': fields.String(required=False,
+                            description='Cursor to request the next page, missing on the last one and on offset '
+                                        'pages not ordered by id')
+})
+
+query_batch_model = api.model('QueryBatch', {
+    'queries': fields.List(fields.Nested(formula_model), required=True, description='Queries to evaluate'),
+    'page': fields.Integer(required=False, description='Page of results, the same for every query')
+})
+
+query_batch_results_model = api.model('QueryBatchResults', {
+    'results': fields.List(fields.Nested(query_results_model), required=True,
+                           description='Results of each query, in the same order')
+})
+
+query_profile_model = api.model('QueryProfile', {
+    'query': fields.Nested(formula_model, required=True, description='Query to evaluate'),
+    'page': fields.Integer(required=False, description='Page of results'),
+    'cursor': fields.String(required=False,
+                            description='Cursor of the previous page (empty for the first one), '
+                                        'it takes precedence over page'),
+    'explain': fields.Boolean(required=False,
+                              description='Only plan the query (EXPLAIN) instead of running it (PROFILE)')
+})
+
+query_count_request_model = api.model('QueryCountRequest', {
+    'query': fields.Nested(formula_model, required=True, description='Query to evaluate'),
+    'timeout': fields.Float(required=False, description='Seconds available to compute the exact count')
+})
+
+query_count_model = api.model('QueryCount', {
+    'count': fields.Integer(required=True, description='Number of distinct results'),
+    'exact': fields.Boolean(required=True, description='False if count is an estimate, as the timeout expired')
 })
 
 query_comparison_model = api.model('QueryComparison', {
     'query1': fields.Nested(formula_model, required=True, description='First query'),
     'query2': fields.Nested(formula_model, required=True, description='Second query'),
-    'page': fields.Integer(required=False, description='Page of results')
+    'page': fields.Integer(required=False, description='Page of results'),
+    'cursor': fields.String(required=False,
+                            description='Cursor of the previous page (empty for the first one), '
+                                        'it takes precedence over page')
 })
 
 term_in_query_model = api.model('TermQuery', {
@@ -131,10 +178,21 @@ term_in_query_model = api.model('TermQuery', {
     'query': fields.Nested(formula_model, required=True, description='Query to evaluate')
 })
 
+terms_in_query_model = api.model('TermsQuery', {
+    'terms': fields.List(fields.String(), required=True,
+                         description='The list of synset id that have to occur in query results'),
+    'query': fields.Nested(formula_model, required=True, description='Query to evaluate')
+})
+
 boolean_answer_model = api.model('BooleanAnswer', {
     'answer': fields.Boolean(required=True, description='The outcome of the required check')
 })
 
+boolean_answers_model = api.model('BooleanAnswers', {
+    'answers': fields.List(fields.Boolean(), required=True,
+                           description='The outcome of the required check for each input, in the same order')
+})
+
 check_superclasses_model = api.model('CheckSuperclasses', {
     'term': fields.String(required=True, description='The synset id'),
     'superclasses': fields.List(fields.String(), required=True,
@@ -172,6 +230,15 @@ atom_list_model = api.model('AtomList', {
 })
 expansion_levels_model = api.model('ExpansionLevels', {'levels': fields.List(fields.Nested(formula_model))})
 
+statement_stats_model = api.model('StatementStats', {
+    'statements': fields.Integer(required=True, description='Distinct statement texts executed'),
+    'executions': fields.Integer(required=True, description='Executed statements'),
+    'reused': fields.Integer(required=True, description='Executions of an already seen statement text'),
+    'untracked': fields.Integer(required=True, description='Executions of texts beyond the tracking limit'),
+    'reuse_ratio': fields.Float(required=True, description='Share of tracked executions reusing a cached plan'),
+    'most_executed': fields.List(fields.Raw(), required=True, description='Most executed statement texts')
+})
+
 sizes_model = api.model('Sizes', {
     'shown': fields.Integer(required=True, description=''),
     'kern': fields.Integer(required=True, description=''),
@@ -198,6 +265,18 @@ class Index(Resource):
         return "Welcome to eXsim :)"
 
 
+@api.route('/api/stats/statements')
+class StatementStats(Resource):
+
+    @api.response(200, 'Success', model=statement_stats_model)
+    def get(self):
+        return app.response_class(
+            response=jsonpickle.encode(statement_stats.stats(), unpicklable=False),
+            status=200,
+            mimetype='application/json'
+        )
+
+
 @api.route('/api/search/id/<string:bn_id>')
 @api.doc(params={'id': 'a valid babelnet id'})
 class SearchById(Resource):
@@ -254,7 +333,10 @@ class SummaryConfigurator(Resource):
         body = api.payload
 
         unit = json_to_unit(body)
-        config = sm.summary_configurator(unit)
+        if DatasetManager().async_summaries:
+            config = AsyncDatasetManager().run(sm.summary_configurator_async(unit))
+        else:
+            config = sm.summary_configurator(unit)
 
         return app.response_class(
             response=repr(config),
@@ -273,7 +355,10 @@ class SummaryComputer(Resource):
 
         response: Unit = json_to_unit(body["unit"])
         config: SummaryConfig = json_to_summary_config(body["summary_config"])
-        sm.summary_selector(response, config)
+        if DatasetManager().async_summaries:
+            AsyncDatasetManager().run(sm.summary_selector_async(response, config))
+        else:
+            sm.summary_selector(response, config)
 
         return app.response_class(
             response=repr(response),
@@ -407,8 +492,9 @@ class QueryExecutor(Resource):
         query = json_to_formula(body["query"])
         exclude_both_constants = body.get("exclude_both_constants", False)
         page = body.get("page", 0)
+        cursor = body.get("cursor", None)
 
-        results = qm.execute_query(query, exclude_both_constants, page)
+        results = qm.execute_query(query, exclude_both_constants, page, cursor)
 
         return app.response_class(
             response=repr(results),
@@ -417,6 +503,72 @@ class QueryExecutor(Resource):
         )
 
 
+@api.route('/api/query/batch')
+class QueryBatchExecutor(Resource):
+    @api.expect(query_batch_model, validate=True)
+    @api.response(200, 'Success', model=query_batch_results_model)
+    def post(self):
+        body = api.payload
+        queries = list(map(json_to_formula, body["queries"]))
+        page = body.get("page", 0)
+
+        results = qm.execute_queries(queries, page)
+
+        return app.response_class(
+            response=jsonpickle.encode({'results': results}, unpicklable=False),
+            status=200,
+            mimetype='application/json'
+        )
+
+
+@api.route('/api/query/count')
+class QueryCounter(Resource):
+    @api.expect(query_count_request_model, validate=True)
+    @api.response(200, 'Success', model=query_count_model)
+    @api.response(400, 'Query can not be evaluated')
+    def post(self):
+        body = api.payload
+        query = json_to_formula(body["query"])
+
+        result = qm.count_query(query, body.get("timeout", None))
+
+        if result is None:
+            return app.response_class(
+                response='The query can not be evaluated',
+                status=400
+            )
+
+        return app.response_class(
+            response=repr(result),
+            status=200,
+            mimetype='application/json'
+        )
+
+
+@api.route('/api/query/profile')
+class QueryProfiler(Resource):
+    @api.expect(query_profile_model, validate=True)
+    @api.response(200, 'Success')
+    @api.response(400, 'Query can not be evaluated')
+    def post(self):
+        body = api.payload
+        query = json_to_formula(body["query"])
+
+        result = qm.profile_query(query, body.get("page", 0), body.get("cursor", None), body.get("explain", False))
+
+        if result is None:
+            return app.response_class(
+                response='The query can not be evaluated',
+                status=400
+            )
+
+        return app.response_class(
+            response=jsonpickle.encode(result, unpicklable=False),
+            status=200,
+            mimetype='application/json'
+        )
+
+
 @api.route('/api/query/diff')
 class QueryDiff(Resource):
     @api.expect(query_comparison_model, validate=True)
@@ -426,8 +578,9 @@ class QueryDiff(Resource):
         query1 = json_to_formula(body["query1"])
         query2 = json_to_formula(body["query2"])
         page = body.get("page", 0)
+        cursor = body.get("cursor", None)
 
-        results = qm.compute_diff_output(query1, query2, page)
+        results = qm.compute_diff_output(query1, query2, page, cursor)
 
         return app.response_class(
             response=repr(results),
@@ -470,6 +623,23 @@ class CheckTermInQuery(Resource):
         )
 
 
+@api.route('/api/query/terms')
+class CheckTermsInQuery(Resource):
+    @api.expect(terms_in_query_model, validate=True)
+    @api.response(200, 'Success', model=boolean_answers_model)
+    def post(self):
+        body = api.payload
+        query = json_to_formula(body["query"])
+
+        result = BooleanAnswers(qm.are_terms_in_output(body["terms"], query))
+
+        return app.response_class(
+            response=repr(result),
+            status=200,
+            mimetype='application/json'
+        )
+
+
 @api.route('/api/query/subset')
 class CheckQuerySubset(Resource):
     @api.expect(query_comparison_model, validate=True)
@@ -0,0 +1,67 @@
+import threading
+from functools import lru_cache
+
+
+def relation_pattern(rel: str) -> str:
+    # Relationship types can not be passed as parameters, so they are the only values spliced into statement texts
+    return "`" + rel.replace("`", "``") + "`"
+
+
+def relation_template(template: str):
+    """
+    Returns a function mapping a relation name to the statement obtained replacing {rel} in template.
+    Texts are built once per relation, so each relation always sends Neo4j the very same statement.
+    """
+    @lru_cache(maxsize=None)
+    def statement(rel: str) -> str:
+        return template.replace("{rel}", relation_pattern(rel))
+
+    return statement
+
+
+class StatementStats:
+    """
+    Counts how many times each distinct statement text is executed.
+    Neo4j caches execution plans by query text, so every execution of an already seen text is a plan reuse, while
+    the first one of each text (most likely) paid the planning cost.
+    At most max_statements texts are tracked, executions of further ones are only counted as untracked.
+    """
+
+    def __init__(self, max_statements: int = 10000) -> None:
+        self.max_statements = max_statements
+        self.executions = {}
+        self.untracked = 0
+        self.lock = threading.Lock()
+
+    def record(self, query: str):
+        with self.lock:
+            if query in self.executions:
+                self.executions[query] += 1
+            elif len(self.executions) < self.max_statements:
+                self.executions[query] = 1
+            else:
+                self.untracked += 1
+
+    def stats(self, top: int = 10) -> dict:
+        with self.lock:
+            executions = sum(self.executions.values())
+            statements = len(self.executions)
+            most_executed = sorted(self.executions.items(), key=lambda item: item[1], reverse=True)[:top]
+            untracked = self.untracked
+
+        return {"statements": statements, "executions": executions + untracked, "reused": executions - statements,
+                "untracked": untracked, "reuse_ratio": (executions - statements) / executions if executions > 0 else 0,
+                "most_executed": [{"statement": query, "executions": count} for query, count in most_executed]}
+
+    def clear(self):
+        with self.lock:
+            self.executions.clear()
+            self.untracked = 0
+
+
+statement_stats = StatementStats()
+
+
+def run_statement(tx, query: str, params: dict = None):
+    statement_stats.record(query)
+    return tx.run(query, parameters=params if params is not None else {})
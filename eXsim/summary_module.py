@@ -1,6 +1,11 @@
+import asyncio
+
 from eXsim.models import *
 from eXsim.babelnet import DatasetManager
+from eXsim.babelnet_async import AsyncDatasetManager
 from eXsim.clingo.clingo_for_lca import compute_lca
+from eXsim.graph_snapshot import REACHABILITY_RELATIONS
+from eXsim.lca import least_common_subsumers, least_common_subsumers_from_ancestors
 
 
 def least_common_subsumer_tmp(terms:list[str], pred:str):
@@ -13,121 +18,77 @@ def least_common_subsumer_tmp(terms:list[str], pred:str):
 
     datasetManager = DatasetManager()
 
+    if pred in REACHABILITY_RELATIONS:
+        # The memoised maps only hold the whole ancestor sets if no ancestor lies beyond their bound
+        ancestor_depths = datasetManager.get_ancestor_depths(terms, pred)
+        if all(map(lambda entry: entry[1], ancestor_depths.values())):
+            constants = {term: set(entry[0]) for term, entry in ancestor_depths.items()}
+            common = set.intersection(*constants.values()) if len(constants) > 0 else set()
+            adjacency = datasetManager.get_adjacency_batched(list(common), pred)
+            return least_common_subsumers_from_ancestors(constants, adjacency)
+
     subgraphs = datasetManager.get_subgraphs(terms, rtype)
 
-    #lca = set(compute_lca(terms, subgraphs))
-    lca = set()
+    return least_common_subsumer_from_subgraph(terms, subgraphs)
 
-    constants = {}
-    commonAtoms: set[tuple[str, str]] = set()
-    first = True
-    
-    for term in terms:
-        constants[term] = set()
-        ancestorSet = set([term])
-        localGraph = set(subgraphs)
-        reachedFromSeed = set()
-        while True:
-            reached = set(filter(lambda t:(t[0] in ancestorSet), localGraph))
-            reachedFromSeed = reachedFromSeed.union(reached)
-            localGraph = localGraph.difference(reached)
-            ancestorSet = set(map(lambda t:t[1], reached))
-            constants[term] = constants[term].union(ancestorSet)
-            if len(reached) == 0:
-                break
-        if first:
-            commonAtoms = reachedFromSeed.copy()
-            first = False
-        else:
-            commonAtoms = commonAtoms.intersection(reachedFromSeed)
 
-    subsumer_subgraphs = {}
-    common = set()
-    first = True
-    for term in terms:
-        if first:
-            common = constants[term]
-            first = False
-        else:
-            common = common.intersection(constants[term])
-
-    for subsumer in common:
-        local_new_common_atoms = commonAtoms.copy()
-        ancestorSet = set([subsumer])
-        subsumer_sub = set()
-        while True:
-            reached = set(filter(lambda t:(t[0] in ancestorSet), local_new_common_atoms))
-            subsumer_sub = subsumer_sub.union(reached)
-            local_new_common_atoms = local_new_common_atoms.difference(reached)
-            ancestorSet = set(map(lambda t:t[1], reached))
-            if len(reached) == 0:
-                break
-        
-        subsumer_sub = frozenset(subsumer_sub)
-        if subsumer_sub not in subsumer_subgraphs:
-            subsumer_subgraphs[subsumer_sub] = []
-        subsumer_subgraphs[subsumer_sub].append(subsumer)
+async def least_common_subsumer_async(terms:list[str], pred:str):
+    datasetManager = AsyncDatasetManager()
 
-    orderedSub:list[frozenset] = list(subsumer_subgraphs.keys())
-    orderedSub.sort(key=lambda x:len(x))
-    if len(orderedSub) > 1:
-        for i in range(0, len(orderedSub)):
-            if orderedSub[i] is not None:
-                for j in range(i + 1, len(orderedSub)):
-                    if j < len(orderedSub) and orderedSub[j] is not None:
-                        if orderedSub[i].issubset(orderedSub[j]):
-                            orderedSub[i] = None
-                            break
+    ancestor_depths = await datasetManager.get_ancestor_depths(terms, pred)
+    if all(map(lambda entry: entry[1], ancestor_depths.values())):
+        constants = {term: set(entry[0]) for term, entry in ancestor_depths.items()}
+        common = set.intersection(*constants.values()) if len(constants) > 0 else set()
+        adjacency = await datasetManager.get_adjacency_batched(list(common), pred)
+        return await datasetManager.offload(least_common_subsumers_from_ancestors, constants, adjacency)
 
-    orderedSub = list(filter(lambda x: x is not None, orderedSub))
+    subgraphs = await datasetManager.get_subgraphs(terms, PredicateType.HYPERNYM)
+    return await datasetManager.offload(least_common_subsumer_from_subgraph, terms, subgraphs)
 
 
+def least_common_subsumer_from_subgraph(terms:list[str], subgraphs:list[tuple[str, str]]):
+    #lca = set(compute_lca(terms, subgraphs))
+    return least_common_subsumers(terms, subgraphs)
 
-    for ord in orderedSub:
-        lca = lca.union(set(subsumer_subgraphs[ord]))
 
-    return {"lca": lca, "constants": constants}
+def compute_summary_by_pred_batched(entities, config_entry:SummaryConfigEntry):
+    datasetManager = DatasetManager()
+    bfs_tree = datasetManager.get_bfs_tree_batched(entities, config_entry.predicate_name, config_entry.depth)
 
+    return summary_from_bfs_tree(entities, bfs_tree)
 
-def compute_summary_by_pred_batched(entities, config_entry:SummaryConfigEntry):
+
+def summary_from_bfs_tree(entities, bfs_tree):
     raw_summaries = {}
     level_ranges = {}
     for term in entities:
-        bfs_list = [(term, term, 0)]
-        already_reached_term = {term: 0}
-        level_ranges[term] = {0: [-1, -1]}
+        raw_summaries[term] = []
+        level_ranges[term] = {}
 
-        for level in range(1, config_entry.depth + 1):
-            previous_size = len(bfs_list)
-            datasetManager = DatasetManager()
+    bfs_tree.sort(key=lambda row: row[3])
 
-            if (level - 1) in level_ranges[term]:
-                if config_entry.predicate_name == "IS_A":
-                    synsets = datasetManager.get_reached_synsets_by_hypernym_batched(list(map(lambda element: element[0], bfs_list[level_ranges[term][level - 1][0] + 1:level_ranges[term][level - 1][1] + 2])))
-                else:
-                    synsets = datasetManager.get_reached_synsets_by_relation_batched(list(map(lambda element: element[0], bfs_list[level_ranges[term][level - 1][0] + 1:level_ranges[term][level - 1][1] + 2])), config_entry.predicate_name)
+    for root, synset, parent, level in bfs_tree:
+        summary = raw_summaries[root]
+        if level in level_ranges[root]:
+            level_ranges[root][level][1] = len(summary)
+        else:
+            level_ranges[root][level] = [len(summary), len(summary)]
+        summary.append((synset, parent, level + 1))
 
-                for synset in synsets:
-                    if synset[1] not in already_reached_term:
-                        already_reached_term[synset[1]] = level + 1
-                        bfs_list.append((synset[1], synset[0], level + 1))
+    return raw_summaries, level_ranges
 
-                if len(bfs_list) > previous_size:
-                    level_ranges[term][level] = [level_ranges[term][level - 1][1] + 1, len(bfs_list) - 2]
 
-        del level_ranges[term][0]
-        raw_summaries[term] = bfs_list[1:]
+def compute_transitive_summary_by_pred_batched(entities, config_entry:SummaryConfigEntry):
+    datasetManager = DatasetManager()
+    reached = datasetManager.get_reached_synsets_variable_by_relation_batched(entities, config_entry.predicate_name)
 
-    return raw_summaries, level_ranges
+    return transitive_summary_from_reached(entities, reached)
 
 
-def compute_transitive_summary_by_pred_batched(entities, config_entry:SummaryConfigEntry):
+def transitive_summary_from_reached(entities, reached):
     raw_summaries = {}
     level_ranges = {}
 
-    datasetManager = DatasetManager()
-    reached = datasetManager.get_reached_synsets_variable_by_relation_batched(entities, config_entry.predicate_name)
-
     for term in entities:
         raw_summaries[term] = list(map(lambda r: (r, term, 1), reached[term]))
         level_ranges[term] = {1: [0, len(raw_summaries[term]) - 1]}
@@ -198,6 +159,16 @@ def beautify_summaries(summaries):
             summaries[term]["terms"][full_term.name[0]]["full_repr"] = full_term
 
 
+async def beautify_summaries_async(summaries):
+    datasetManager = AsyncDatasetManager()
+    terms = list(summaries.keys())
+    results = await asyncio.gather(*map(lambda term: datasetManager.get_synsets_by_id_batched(list(summaries[term]["terms"])), terms))
+
+    for term, full_terms in zip(terms, results):
+        for full_term in full_terms:
+            summaries[term]["terms"][full_term.name[0]]["full_repr"] = full_term
+
+
 def new_aggregate_info(summaries, included_types):
     final_summary = {}
 
@@ -242,71 +213,136 @@ def new_aggregate_info(summaries, included_types):
     return final_summary
 
 
+def uses_bfs_summary(summary_approach:SummaryApproach, entry:SummaryConfigEntry):
+    return summary_approach == SummaryApproach.SINGLE_ENTITY or (not is_transitive(entry) and entry.depth == 1)
+
+
 def summary_selector(unit:Unit, config:SummaryConfig):
     summary_approach:SummaryApproach = SummaryApproach.SINGLE_ENTITY if len(unit.entities) == 1 else SummaryApproach.MULTI_ENTITY
 
     entities = list(map(lambda tuple: tuple[0].name[0], unit.entities.keys()))
+    partial_summaries = {}
+    lca_output = None
+
+    for entry in config.included_types:
+        if entry.predicate_name == "IS_A":
+            continue
+
+        if uses_bfs_summary(summary_approach, entry):
+            partial_summaries[entry.predicate_name] = compute_summary_by_pred_batched(entities, entry)
+        else:
+            partial_summaries[entry.predicate_name] = compute_transitive_summary_by_pred_batched(entities, entry)
+
+    if any(map(lambda entry: entry.predicate_name == "IS_A", config.included_types)):
+        lca_output = least_common_subsumer_tmp(entities, "IS_A")
+
+    output = assemble_summaries(entities, config, partial_summaries, lca_output)
+
+    if output is not None:
+        if config.beautify:
+            beautify_summaries(output)
+
+        fill_unit_summaries(unit, output)
+
+
+async def summary_selector_async(unit:Unit, config:SummaryConfig):
+    summary_approach:SummaryApproach = SummaryApproach.SINGLE_ENTITY if len(unit.entities) == 1 else SummaryApproach.MULTI_ENTITY
+
+    datasetManager = AsyncDatasetManager()
+    entities = list(map(lambda tuple: tuple[0].name[0], unit.entities.keys()))
+    entries = list(filter(lambda entry: entry.predicate_name != "IS_A", config.included_types))
+    is_a_found = len(entries) < len(config.included_types)
+
+    # Every relation entry (and the LCA of IS_A) is fetched concurrently
+    fetches = []
+    for entry in entries:
+        if uses_bfs_summary(summary_approach, entry):
+            fetches.append(datasetManager.get_bfs_tree_batched(entities, entry.predicate_name, entry.depth))
+        else:
+            fetches.append(datasetManager.get_reached_synsets_variable_by_relation_batched(entities, entry.predicate_name))
+
+    if is_a_found:
+        fetches.append(least_common_subsumer_async(entities, "IS_A"))
+
+    results = await asyncio.gather(*fetches)
+    lca_output = results[-1] if is_a_found else None
+
+    output = await datasetManager.offload(assemble_fetched_summaries, entities, config, summary_approach, entries,
+                                          results, lca_output)
+
+    if output is not None:
+        if config.beautify:
+            await beautify_summaries_async(output)
+
+        fill_unit_summaries(unit, output)
+
+
+def assemble_fetched_summaries(entities, config:SummaryConfig, summary_approach:SummaryApproach, entries, results,
+                               lca_output):
+    partial_summaries = {}
+    for entry, result in zip(entries, results):
+        if uses_bfs_summary(summary_approach, entry):
+            partial_summaries[entry.predicate_name] = summary_from_bfs_tree(entities, result)
+        else:
+            partial_summaries[entry.predicate_name] = transitive_summary_from_reached(entities, result)
+
+    return assemble_summaries(entities, config, partial_summaries, lca_output)
+
+
+def assemble_summaries(entities, config:SummaryConfig, partial_summaries, lca_output):
     summaries = {}
     for term in entities:
         summaries[term] = {}
 
-    is_a_found = False
-
     for entry in config.included_types:
         if entry.predicate_name == "IS_A":
-            is_a_found = True
             continue
         
         for term in entities:
             summaries[term][entry.predicate_name] = {}
 
-        partial_summaries = {}
-        level_ranges = {}
-
-        if summary_approach == SummaryApproach.SINGLE_ENTITY or (not is_transitive(entry) and entry.depth == 1):
-            partial_summaries, level_ranges = compute_summary_by_pred_batched(entities, entry)
-        else:
-            partial_summaries, level_ranges = compute_transitive_summary_by_pred_batched(entities, entry)
+        entry_summaries, level_ranges = partial_summaries[entry.predicate_name]
             
-        for term in partial_summaries.keys():
+        for term in entry_summaries.keys():
             if "terms" not in summaries[term]:
                 summaries[term]["terms"] = {}
         
-            merge_reached_terms(summaries[term]["terms"], map(lambda sum_entry: sum_entry[0], partial_summaries[term]))
+            merge_reached_terms(summaries[term]["terms"], map(lambda sum_entry: sum_entry[0], entry_summaries[term]))
 
-            summaries[term][entry.predicate_name]["atoms"] = partial_summaries[term]
+            summaries[term][entry.predicate_name]["atoms"] = entry_summaries[term]
             summaries[term][entry.predicate_name]["level_ranges"] = level_ranges[term]
 
-    if is_a_found:
-        lca_output = least_common_subsumer_tmp(entities, "IS_A")
-
+    if lca_output is not None:
         for term in lca_output["constants"]:
             if "terms" not in summaries[term]:
                 summaries[term]["terms"] = {}
 
-        partial_summaries, level_ranges = construct_summaries_from_lca_output(lca_output, summaries)
+        entry_summaries, level_ranges = construct_summaries_from_lca_output(lca_output, summaries)
         
         for term in lca_output["constants"]:
-            merge_reached_terms(summaries[term]["terms"], map(lambda sum_entry: sum_entry[0], partial_summaries[term]))
+            merge_reached_terms(summaries[term]["terms"], map(lambda sum_entry: sum_entry[0], entry_summaries[term]))
 
             summaries[term]["IS_A"] = {}
-            summaries[term]["IS_A"]["atoms"] = partial_summaries[term]
+            summaries[term]["IS_A"]["atoms"] = entry_summaries[term]
             summaries[term]["IS_A"]["level_ranges"] = level_ranges[term]
         
-    if "terms" in summaries[term]:
-        if config.optimization_strategy == OptimizationStrategy.FULL_OPT:
-            output = new_aggregate_info(summaries, config.included_types)
-        else:
-            output = transform_summaries(summaries, config.included_types)
+    if "terms" not in summaries[term]:
+        return None
 
-        if config.include_top:
-            add_tops(output)
-        
-        if config.beautify:
-            beautify_summaries(output)
-        
-        for entity in unit.entities:
-            unit.entities[entity] = Summary(output[entity[0].name[0]]["summary"], list(map(lambda term: SummaryTerm(term, output[entity[0].name[0]]["terms"][term]['occurrences'], output[entity[0].name[0]]["terms"][term].get('full_repr', None)), output[entity[0].name[0]]["terms"].keys())))
+    if config.optimization_strategy == OptimizationStrategy.FULL_OPT:
+        output = new_aggregate_info(summaries, config.included_types)
+    else:
+        output = transform_summaries(summaries, config.included_types)
+
+    if config.include_top:
+        add_tops(output)
+
+    return output
+
+
+def fill_unit_summaries(unit:Unit, output):
+    for entity in unit.entities:
+        unit.entities[entity] = Summary(output[entity[0].name[0]]["summary"], list(map(lambda term: SummaryTerm(term, output[entity[0].name[0]]["terms"][term]['occurrences'], output[entity[0].name[0]]["terms"][term].get('full_repr', None)), output[entity[0].name[0]]["terms"].keys())))
 
 
 def summary_configurator(unit:Unit):
@@ -314,12 +350,24 @@ def summary_configurator(unit:Unit):
 
     entities = list(map(lambda tuple: tuple[0].name[0], unit.entities.keys()))
 
+    return summary_config_from_entries(list(map(datasetManager.get_summary_config, entities)))
+
+
+async def summary_configurator_async(unit:Unit):
+    datasetManager = AsyncDatasetManager()
+
+    entities = list(map(lambda tuple: tuple[0].name[0], unit.entities.keys()))
+
+    return summary_config_from_entries(await asyncio.gather(*map(datasetManager.get_summary_config, entities)))
+
+
+def summary_config_from_entries(results:list[list[SummaryConfigEntry]]):
+    datasetManager = DatasetManager()
+
     entries = set()
     first = True
 
-    for entity in entities:
-        result = datasetManager.get_summary_config(entity)
-
+    for result in results:
         if first:
             entries = set(result)
             first = False
@@ -343,6 +391,25 @@ def summary_configurator(unit:Unit):
 
 
 def compute_common_by_pred_list(term, common_to_check, pred):
+    reachability_index = DatasetManager().reachability_index(pred)
+    if reachability_index is not None:
+        # The labels only tell whether a candidate is an ancestor at all: unreachable candidates are dropped without
+        # any traversal, the distance of the reachable ones is still needed for the 10 levels cap and the ordering
+        common_to_check = [common for common in dict.fromkeys(common_to_check)
+                           if common != term and reachability_index.reaches(pred, term, common)]
+        if len(common_to_check) == 0:
+            return []
+
+    # Memoised ancestors answer without any traversal, otherwise the search below stops as soon as every candidate
+    # has been found
+    cached = None
+    if pred in REACHABILITY_RELATIONS and DatasetManager().ancestor_depth >= 10:
+        cached = DatasetManager().cached_ancestor_depths([term], pred)
+    if cached is not None:
+        depths = cached[term]
+        found = [common for common in dict.fromkeys(common_to_check) if common != term and depths.get(common, 11) <= 10]
+        return sorted(found, key=lambda common: depths[common])
+
     level_ranges = {}
     bfs_list = [(term, term, 0)]
     common_found = []
@@ -376,81 +443,149 @@ def compute_common_by_pred_list(term, common_to_check, pred):
     return common_found
 
 
+def nearest_common_ancestors_from_depths(terms: list[str], ancestor_depths: dict[str, dict[str, int]],
+                                         strategy: AncestorStrategy, max_level: int):
+    # Same output of the breadth first search below: common ancestors within max_level from every term, the ones at
+    # minimum total distance (ALL_NEAREST) or the ones completed at the lowest level (UP_TO_LEVEL)
+    candidates = []
+    for synset in set.intersection(*map(set, ancestor_depths.values())):
+        depths = [ancestor_depths[term][synset] for term in terms]
+        if max(depths) <= max_level:
+            candidates.append((synset, depths))
+
+    if len(candidates) == 0:
+        return []
+
+    cost = sum if strategy == AncestorStrategy.ALL_NEAREST else max
+    best = min(map(lambda candidate: cost(candidate[1]), candidates))
+    candidates = list(filter(lambda candidate: cost(candidate[1]) == best, candidates))
+    candidates.sort(key=lambda candidate: (max(candidate[1]), sum(candidate[1]), candidate[0]))
+
+    return [(synset, dict(zip(terms, depths))) for synset, depths in candidates]
+
+
+def prune_frontier(frontier: dict[str, int], level: int, seed_depths: list[int], level_of, best_depth: int or None,
+                   max_level: int) -> dict[str, int]:
+    # Every ancestor a of a synset x is at least depth(term) - level(x) away from each term, since the shortest way
+    # from a term to a root is not longer than the one through a and a is not deeper than x. The origins of x whose
+    # continuations can only complete beyond max_level, or with a total depth above the best found, are dropped
+    pruned = {}
+
+    for synset, origins in frontier.items():
+        bounds = list(map(lambda seed_depth: max(1, seed_depth - level_of(synset)), seed_depths))
+        kept = 0
+        remaining = origins
+
+        while remaining:
+            lowest = remaining & -remaining
+            i = lowest.bit_length() - 1
+            others = bounds[:i] + bounds[i + 1:]
+            if ((best_depth is None or level + 1 + sum(others) <= best_depth)
+                    and max([level + 1] + others) <= max_level):
+                kept |= lowest
+            remaining ^= lowest
+
+        if kept != 0:
+            pruned[synset] = kept
+
+    return pruned
+
+
 def nearest_common_ancestor_batched(terms:list[str], pred:str, strategy:AncestorStrategy = AncestorStrategy.ALL_NEAREST, max_level:int = 10, summary_strategy:SummaryStrategy = SummaryStrategy.NO_SUMMARY, depth=1, prune_common=True):
+    terms = list(dict.fromkeys(terms))
     num_terms = len(terms)
-    previous_size = 0
-    bfs_list = list(map(lambda x: (x, x, x, 0), terms))
-
-    # TODO! E' ARRIVATO IL MOMENTO DI GESTIRE CICLI COME SI DEVE!
-    # NON E' CARINISSIMO VEDERE CHE UN NODO LO SI PUO' RAGGIUNGERE IN UN MODO SOLO!
-    # SE UN NODO E' RAGGIUNGIBILE DA PIU' NODI NON VIENE PROPRIO CONSIDERATO POI NEL SUMMARY
-    # E OKAY CHE MI INTERESSA SOLO LA DISTANZA MINIMA, MA SE QUESTA ADDIRITTURA E' LA STESSA
-    # POTREI NON METTERE IN BFS_LIST LE RIPETIZIONI, COSI' DA NON FAR RICALCOLARE DOVE VA UNO STESSO TERMINE
-    # MA L'INFORMAZIONE CHE QUESTO VIENE RAGGIUNTO DA PIU' NODI NON E' BELLO BUTTARLA
-    # TUTTAVIA, NEL CASO IN CUI QUESTO NODO E' RAGGIUNGIBILE DAL NODO RAGGIUNTO VA MALISSIMO
-    # PERCHE' SIGNIFICA CHE PRENDERE QUESTO ATOMO CHIUDE UN CICLO, ED IO NON LO VOGLIO MANCO PAGATO!
-    # TODO! ATTENTO, POTREBBE ESSERCI UN CICLO CHE RIPORTA ALLA SORGENTE! MALE MALE MALE
-    already_reached_term:dict[str, dict[str, int]] = {}
-    stop = False
-    # AGGIUNTA STRUTTURA CHE PER OGNI LIVELLO RIPORTA QUALI TERMINI DI PARTENZA SONO COMPARSI
-    # SE A FINE LIVELLO NON SONO COMPARSI TUTTI I TERMINI, NEL MOMENTO IN CUI UN PUNTO DI INCONTRO NON E' STATO TROVATO
-    # BEH, FERMATI COMUNQUE PERCHE' NON LO TROVERAI MAI, IN QUANTO PER ALMENO UNO DEI TERMINI NON CI SONO PIU' RELAZIONI DA
-    # ESPLORARE
-    # COMMENTO POSTUMO: STA ROBA E' ERRATA, UN CONTROLLO CHE PUO' AVER SENSO E' QUELLO DI VERIFICARE CHE ALMENO A LIVELLO 1 COMPAIONO TUTTI
-    # IN QUANTO SIGNIFICA CHE POTENZIALMENTE SI PUO' TROVARE.
-    # IN CASO CONTRARIO SAREBBE IMPOSSIBILE TROVARE UN COMMON ANCESTOR, IN QUANTO UN'ENTITA' NON HA PROPRIO UN ANCESTOR...
-    involved_input_terms_level = {}
-    # TODO! SEGNATI IN UNA STRUTTURA AUSILIARIA RIPETIZIONE A UNO STESSO TERMINE RAGGIUNTO ALLO STESSO LIVELLO E AGGIUNGILO A BFS_LIST
-    # IN QUALCHE MODO ALLA FINE!
-    # VALUTA DI TRASFORMARLO IN UN DICT PER OTTIMIZZARE LA RICERCA DOPO!
+    if num_terms == 0:
+        return []
+
+    datasetManager = DatasetManager()
+    level_index = datasetManager.level_index(pred)
+    seed_depths = None
+
+    if level_index is not None:
+        # Terms without a common root have no common ancestor at all, whatever the level
+        seeds = list(map(level_index.index_of, terms))
+        if min(seeds) < 0:
+            return []
+        if len(set.intersection(*map(lambda seed: level_index.ancestor_roots(pred, seed), seeds))) == 0:
+            return []
+        seed_depths = list(map(lambda seed: level_index.depth(pred, seed), seeds))
+
+    last_level = 99 if max_level == -1 else max_level
+
+    # Memoised ancestors answer without any traversal, otherwise the search below stops at the first level completing
+    # a common ancestor
+    if pred in REACHABILITY_RELATIONS and last_level <= datasetManager.ancestor_depth:
+        cached = datasetManager.cached_ancestor_depths(terms, pred)
+        if cached is not None:
+            return nearest_common_ancestors_from_depths(terms, cached, strategy, last_level)
+
+    # Level-synchronous multi-source BFS: bit i of reached_mask[synset] is set once terms[i] reached synset, and
+    # depths[synset][i] is the level at which it happened. A synset is expanded again only for the origins that
+    # reached it for the first time, so cycles and multiple paths are visited once per origin
+    full_mask = (1 << num_terms) - 1
+    reached_mask: dict[str, int] = {}
+    depths: dict[str, list[int]] = {}
+    frontier: dict[str, int] = {term: 1 << i for i, term in enumerate(terms)}
     nearest_common_ancestors = []
+    best_depth = None
 
-    for level in range(1, 100 if max_level == -1 else max_level + 1):
-        if stop or (level > 1 and len(involved_input_terms_level) < num_terms) or previous_size == len(bfs_list):
+    for level in range(1, last_level + 1):
+        if len(frontier) == 0:
             break
 
-        datasetManager = DatasetManager()
+        # An ancestor completed at this level has a total depth of at least level + (num_terms - 1)
+        if best_depth is not None and (strategy != AncestorStrategy.ALL_NEAREST or level + num_terms - 1 > best_depth):
+            break
 
         if pred == "IS_A":
-            synsets = datasetManager.get_reached_synsets_by_hypernym_batched(list(set(map(lambda element: element[1], bfs_list[previous_size:]))))
+            synsets = datasetManager.get_reached_synsets_by_hypernym_batched(list(frontier))
         else:
-            synsets = datasetManager.get_reached_synsets_by_relation_batched(list(set(map(lambda element: element[1], bfs_list[previous_size:]))), pred)
-
-        previous_size = len(bfs_list)
-        bfs_dict = {}
-
-        for synset in synsets:
-            # IF IT IS NOT ALREADY REACHED AT ALL OR FROM SOURCE element[0]:
-            if synset[1] not in already_reached_term:
-                already_reached_term[synset[1]] = {}
+            synsets = datasetManager.get_reached_synsets_by_relation_batched(list(frontier), pred)
 
-            origins = [synset[0]] if level == 1 else already_reached_term[synset[0]].keys()
+        next_frontier: dict[str, int] = {}
 
-            for origin in origins:
-                if origin not in bfs_dict:
-                    bfs_dict[origin] = []
-
-                involved_input_terms_level[origin] = True
+        for source, synset in synsets:
+            new_origins = frontier[source] & ~reached_mask.get(synset, 0)
+            if new_origins == 0:
+                continue
 
-                if origin not in already_reached_term[synset[1]]:
-                    # ADD TO ALREADY REACHED, DECLARE IN THE MAP THAT SOURCE element[0] REACHED TERM X IN STEPS level
-                    already_reached_term[synset[1]][origin] = level
+            if synset not in reached_mask:
+                reached_mask[synset] = 0
+                depths[synset] = [0] * num_terms
+
+            reached_mask[synset] |= new_origins
+            next_frontier[synset] = next_frontier.get(synset, 0) | new_origins
+
+            origins = new_origins
+            while origins:
+                lowest = origins & -origins
+                depths[synset][lowest.bit_length() - 1] = level
+                origins ^= lowest
+
+            if reached_mask[synset] == full_mask:
+                total_depth = sum(depths[synset])
+                nearest_common_ancestors.append((synset, dict(zip(terms, depths[synset]))))
+                if best_depth is None or total_depth < best_depth:
+                    best_depth = total_depth
+
+        # If some term has no ancestor at all, a common one can not exist
+        if level == 1 and best_depth is None:
+            involved = 0
+            for origins in next_frontier.values():
+                involved |= origins
+            if involved != full_mask:
+                break
 
-                    # IF SUCH TERM IS REACHED BY ALL SOURCES, I.E. len(already_reached_term[TERM]) == num_terms:
-                    if len(already_reached_term[synset[1]].keys()) == num_terms:
-                        # YEEEEEEEEEEEE! EVERYONE IS HAPPY, COMMON ANCESTOR!!!
-                        nearest_common_ancestors.append((synset[1], already_reached_term[synset[1]]))
-                        stop = True
-                    
-                    # APPEND TUPLE (element[0], TERM) TO bfs_list
-                    bfs_dict[origin].append((origin, synset[1], synset[0], level))
+        if seed_depths is not None:
+            bound = best_depth if strategy == AncestorStrategy.ALL_NEAREST else None
+            next_frontier = prune_frontier(next_frontier, level, seed_depths,
+                                           lambda synset: level_index.level(pred, level_index.index_of(synset)),
+                                           bound, last_level)
 
-        for term in terms:
-            if term in bfs_dict:
-                bfs_list.extend(bfs_dict[term])
+        frontier = next_frontier
     
     if strategy == AncestorStrategy.ALL_NEAREST and len(nearest_common_ancestors) > 0:
         min_depth = min(map(lambda ancestor: sum(ancestor[1].values()), nearest_common_ancestors))
         nearest_common_ancestors = list(filter(lambda ancestor: sum(ancestor[1].values()) == min_depth, nearest_common_ancestors))
 
-    return nearest_common_ancestors
\ No newline at end of file
+    return nearest_common_ancestors